@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+Benchmark the ingest and query hot paths on a synthetic corpus
+Usage: python benchmark.py [--docs 200] [--queries 50] [--output results.json]
+
+Stages timed: rag.py startup (a fresh `rag.py --help` process), chunking,
+embedding, inserting, top-k search and the end-to-end query (retrieve + prompt
++ LLM). The startup stage also lists any heavy module rag.py imported before
+parsing its arguments; there should be none. Postgres and Ollama are not required: unless
+--pg is given, vectors go to an in-process store, and the LLM is a local stub
+HTTP server that speaks Ollama's /api/generate protocol. Without
+sentence-transformers (or with --hashing-embedder) a deterministic hashing
+embedder stands in for the model so the suite runs fully offline.
+
+A recall@k vs memory table compares the in-process store's quantized variants
+(halfvec, int8, binary, each re-ranked exactly, and IVF) against exact float32
+search over the same embeddings. Its recall is only meaningful with the real
+model: the hashing embedder's sparse vectors defeat binary quantization, so the
+table comes with a warning then.
+
+Results are written as JSON (p50/p95/p99 latency and throughput per stage, plus
+the parameters and git commit) so runs can be compared across commits.
+"""
+
+import os
+import sys
+import json
+import logging
+import time
+import random
+import hashlib
+import argparse
+import platform
+import threading
+import subprocess
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "encoder"))
+
+import rag
+from embedders import BACKENDS, compare_embedders, load_embedder as load_backend
+from vectorstore import PG_QUANTIZED_EXPRESSIONS, QUANTIZATIONS, NumPyVectorStore, PgVectorStore, SearchFilter
+from chunking import chunk_text, kind_for, make_token_counter
+
+VOCABULARY = (
+    "vector index query chunk embedding database docker service model token latency "
+    "postgres ollama encoder retrieval context answer prompt search cosine distance "
+    "config error timeout memory cpu gpu batch insert commit transaction cache file"
+).split()
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Benchmark RAG ingest and query hot paths')
+    parser.add_argument('--docs', type=int, default=200, help='Synthetic documents to generate (default: 200)')
+    parser.add_argument('--words', type=int, default=800, help='Average words per document (default: 800)')
+    parser.add_argument('--queries', type=int, default=50, help='Queries to time (default: 50)')
+    parser.add_argument('--limit', type=int, default=5, help='Top-k for search (default: 5)')
+    parser.add_argument('--batch-size', type=int, default=32, help='Embedding batch size (default: 32)')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed for the corpus (default: 42)')
+    parser.add_argument('--hashing-embedder', action='store_true',
+                        help='Use the offline hashing embedder even if sentence-transformers is installed')
+    parser.add_argument('--embedding-backend', choices=BACKENDS, default=rag.DEFAULT_BACKEND,
+                        help='Embedding model runtime; non-torch backends are also checked against torch')
+    parser.add_argument('--embedding-threads', type=int, default=rag.DEFAULT_THREADS,
+                        help='CPU threads for the embedding model, 0 for the runtime default (default: 0)')
+    parser.add_argument('--pg', action='store_true',
+                        help='Insert into and search a temporary pgvector table instead of the in-process store')
+    parser.add_argument('--ivf', action='store_true',
+                        help='Search the in-process store through its IVF index instead of exactly')
+    parser.add_argument('--quantization', choices=QUANTIZATIONS, default='none',
+                        help='Quantize the timed store, re-ranking candidates exactly (default: none)')
+    parser.add_argument('--llm-tokens', type=int, default=64, help='Tokens the stub LLM generates (default: 64)')
+    parser.add_argument('--llm-token-delay', type=float, default=0.0,
+                        help='Seconds the stub LLM waits per token (default: 0)')
+    parser.add_argument('--startup-runs', type=int, default=5,
+                        help='Fresh rag.py --help processes to time, 0 to skip (default: 5)')
+    parser.add_argument('--output', '-o', help='Write the JSON results to this file')
+    return parser.parse_args()
+
+# ---------------------------------------------------------------------------
+# Measurement helpers
+# ---------------------------------------------------------------------------
+
+def summarize(samples, items=None):
+    """Latency percentiles (ms) for a list of per-call durations, plus throughput."""
+    samples = np.asarray(samples, dtype=np.float64)
+    total = float(samples.sum())
+    summary = {
+        "count": int(samples.size),
+        "p50_ms": float(np.percentile(samples, 50) * 1000),
+        "p95_ms": float(np.percentile(samples, 95) * 1000),
+        "p99_ms": float(np.percentile(samples, 99) * 1000),
+        "mean_ms": float(samples.mean() * 1000),
+        "total_s": total,
+    }
+    if total > 0:
+        summary["items_per_s"] = (items if items is not None else samples.size) / total
+    return summary
+
+def timed(fn, *args, **kwargs):
+    """Run fn and return (result, seconds)."""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent).stdout.strip() or None
+    except FileNotFoundError:
+        return None
+
+# ---------------------------------------------------------------------------
+# Synthetic corpus and offline stand-ins
+# ---------------------------------------------------------------------------
+
+def generate_corpus(num_docs, avg_words, seed=42):
+    """Return a list of (filename, text) with a mix of Markdown and Python-like documents."""
+    rng = random.Random(seed)
+    docs = []
+    for i in range(num_docs):
+        words = max(1, int(rng.gauss(avg_words, avg_words / 4)))
+        body = " ".join(rng.choice(VOCABULARY) for _ in range(words))
+        if i % 3 == 0:
+            docs.append((f"module_{i}.py", f"def handler_{i}():\n    \"\"\"{body}\"\"\"\n"))
+        else:
+            docs.append((f"doc_{i}.md", f"# Document {i}\n\n{body}\n"))
+    return docs
+
+def generate_queries(num_queries, seed=42):
+    rng = random.Random(seed + 1)
+    return [" ".join(rng.choice(VOCABULARY) for _ in range(rng.randint(3, 10))) for _ in range(num_queries)]
+
+# Modules rag.py must not import before it needs them: embedding runtimes, database and HTTP clients
+HEAVY_MODULES = ("torch", "transformers", "sentence_transformers", "onnxruntime", "psycopg2", "requests", "httpx")
+
+class HashingEmbedder:
+    """Deterministic bag-of-words hashing embedder with the model's output shape."""
+
+    name = "hashing-384"
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().split():
+                h = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+                out[row, h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        return out / np.maximum(norms, 1e-12)
+
+class PgVectorBenchStore(PgVectorStore):
+    """pgvector store on a temporary table (dropped with the connection)."""
+
+    def __init__(self, quantization="none"):
+        conn = rag.connect_to_database()
+        if conn is None:
+            raise RuntimeError("PostgreSQL is not reachable")
+        super().__init__(conn, table="bench_documents", quantization=quantization)
+        cur = self.conn.cursor()
+        cur.execute("CREATE TEMP TABLE bench_documents (LIKE documents INCLUDING DEFAULTS);")
+        self.conn.commit()
+
+    def build_index(self):
+        if self.quantization == "none":
+            column = "embedding vector_cosine_ops"
+        else:
+            opclass = "halfvec_cosine_ops" if self.quantization == "halfvec" else "bit_hamming_ops"
+            column = f"{PG_QUANTIZED_EXPRESSIONS[self.quantization][0]} {opclass}"
+        cur = self.conn.cursor()
+        cur.execute(f"CREATE INDEX ON bench_documents USING hnsw ({column});")
+        cur.execute("ANALYZE bench_documents;")
+        self.conn.commit()
+
+def start_stub_ollama(tokens=64, token_delay=0.0):
+    """Serve a minimal Ollama /api/generate on a free localhost port; returns (server, url)."""
+
+    class StubOllama(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body go out as separate small writes; with Nagle's algorithm the second
+        # waits ~40ms for the client's delayed ACK, which would swamp the blocking path's timings
+        disable_nagle_algorithm = True
+
+        def _chunk(self, payload):
+            data = (json.dumps(payload) + "\n").encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            words = [f"tok{i} " for i in range(tokens)]
+            if request.get("stream"):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for word in words:
+                    time.sleep(token_delay)
+                    self._chunk({"response": word, "done": False})
+                self._chunk({"response": "", "done": True, "eval_count": tokens})
+                self.wfile.write(b"0\r\n\r\n")
+            else:
+                time.sleep(token_delay * tokens)
+                body = json.dumps({"response": "".join(words), "done": True}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubOllama)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def load_embedder(force_hashing=False, backend="torch", threads=0):
+    if not force_hashing:
+        try:
+            model = load_backend(backend, threads)
+            model.name = f"{rag.EMBEDDING_MODEL} ({backend})"
+            return model
+        except Exception as e:
+            print(f"⚠️  Embedding model unavailable ({e}), using the hashing embedder")
+    return HashingEmbedder()
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+# ---------------------------------------------------------------------------
+
+def bench_startup(runs):
+    """Time fresh `rag.py --help` processes and list heavy modules imported on the way."""
+    command = [sys.executable, str(Path(__file__).resolve().parent / "rag.py"), "--help"]
+    samples = [timed(subprocess.run, command, capture_output=True, check=True)[1] for _ in range(runs)]
+    trace = subprocess.run([sys.executable, "-X", "importtime", *command[1:]], capture_output=True, text=True).stderr
+    # -X importtime lines look like "import time:   self |  cumulative | <indent>package.module"
+    imported = {line.rsplit("|", 1)[1].strip().split(".")[0] for line in trace.splitlines() if line.count("|") == 2}
+    return summarize(samples), sorted(imported & set(HEAVY_MODULES))
+
+def bench_chunking(docs, count_tokens=None):
+    rows, samples = [], []
+    for filename, text in docs:
+        chunks, seconds = timed(chunk_text, text, kind_for(filename), count_tokens)
+        samples.append(seconds)
+        rows.extend((filename, i, chunk) for i, chunk in enumerate(chunks))
+    return rows, summarize(samples)
+
+def bench_embedding(embedder, texts, batch_size):
+    samples, parts = [], []
+    for start in range(0, len(texts), batch_size):
+        batch = texts[start:start + batch_size]
+        embeddings, seconds = timed(embedder.encode, batch, batch_size=batch_size)
+        parts.append(np.asarray(embeddings, dtype=np.float32))
+        samples.append(seconds)
+    return np.vstack(parts), summarize(samples, items=len(texts))
+
+def insert_batch(store, rows, embeddings):
+    store.add(rows, embeddings)
+    store.commit()
+
+def bench_insert(store, rows, embeddings, batch_size=500):
+    samples = []
+    for start in range(0, len(rows), batch_size):
+        _, seconds = timed(insert_batch, store, rows[start:start + batch_size], embeddings[start:start + batch_size])
+        samples.append(seconds)
+    return summarize(samples, items=len(rows))
+
+def bench_search(store, query_vectors, limit, filters=None):
+    samples = [timed(store.search, vector, limit, filters=filters)[1] for vector in query_vectors]
+    return summarize(samples)
+
+def bench_end_to_end(embedder, store, queries, limit, stream):
+    samples = []
+    for query in queries:
+        start = time.perf_counter()
+        vector = embedder.encode([query])[0]
+        rows = store.search(vector, limit)
+        prompt, _ = rag.build_prompt(query, [row[:3] for row in rows])
+        rag.query_llm(prompt, stream=stream, on_token=lambda token: None)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+def bench_quantization(rows, embeddings, query_vectors, limit):
+    """Recall@limit against exact float32 search, memory and search latency per store variant."""
+    variants = [(quantization, False) for quantization in QUANTIZATIONS] + [("none", True), ("binary", True)]
+    exact = NumPyVectorStore()
+    exact.add(rows, embeddings)
+    truth = [{result.id for result in exact.search(vector, limit)} for vector in query_vectors]
+    report = {}
+    for quantization, ivf in variants:
+        store = NumPyVectorStore(quantization=quantization)
+        store.add(rows, embeddings)
+        if ivf:
+            store.build_index()
+        found, samples = [], []
+        for vector in query_vectors:
+            results, seconds = timed(store.search, vector, limit)
+            found.append({result.id for result in results})
+            samples.append(seconds)
+        recall = np.mean([len(hits & expected) / max(len(expected), 1) for hits, expected in zip(found, truth)])
+        # What has to stay in memory to search when the float32 matrix is mmapped from disk
+        resident = store.memory_bytes() - (store.matrix.nbytes if quantization != "none" else 0)
+        report[quantization + ("+ivf" if ivf else "")] = {
+            "recall": float(recall), "resident_bytes": int(resident), **summarize(samples),
+        }
+    return report
+
+def main():
+    """Run every benchmark and print / save the results."""
+    args = parse_arguments()
+    rag.logger.setLevel("WARNING")
+    logging.getLogger("vectorstore").setLevel("WARNING")
+
+    docs = generate_corpus(args.docs, args.words, args.seed)
+    queries = generate_queries(args.queries, args.seed)
+    embedder = load_embedder(args.hashing_embedder, args.embedding_backend, args.embedding_threads)
+    if args.pg:
+        store = PgVectorBenchStore(args.quantization)
+    else:
+        store = NumPyVectorStore(quantization=args.quantization)
+    server, rag.OLLAMA_URL = start_stub_ollama(args.llm_tokens, args.llm_token_delay)
+
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "params": {**vars(args), "embedder": embedder.name, "store": type(store).__name__},
+        "stages": {},
+    }
+    stages = results["stages"]
+
+    if args.startup_runs:
+        stages["startup"], results["startup_heavy_imports"] = bench_startup(args.startup_runs)
+        if results["startup_heavy_imports"]:
+            print(f"⚠️  rag.py imports {', '.join(results['startup_heavy_imports'])} at startup")
+
+    print(f"📚 Corpus: {len(docs)} documents, {sum(len(t.split()) for _, t in docs)} words")
+    tokenizer = getattr(embedder, "tokenizer", None)
+    rows, stages["chunk"] = bench_chunking(docs, make_token_counter(tokenizer) if tokenizer else None)
+    embeddings, stages["embed"] = bench_embedding(embedder, [row[2] for row in rows], args.batch_size)
+    stages["insert"] = bench_insert(store, rows, embeddings)
+    if args.pg or args.ivf:
+        store.build_index()
+    query_vectors = np.asarray(embedder.encode(queries), dtype=np.float32)
+    stages["search"] = bench_search(store, query_vectors, args.limit)
+    # Scoped to the Python half of the corpus, as rag.py --type py would
+    stages["search_filtered"] = bench_search(store, query_vectors, args.limit, SearchFilter(file_types=("py",)))
+    stages["end_to_end"] = bench_end_to_end(embedder, store, queries, args.limit, stream=False)
+    stages["end_to_end_stream"] = bench_end_to_end(embedder, store, queries, args.limit, stream=True)
+    results["chunks"] = len(rows)
+    if not isinstance(embedder, HashingEmbedder) and args.embedding_backend != "torch":
+        # Vectors must match the torch model's closely enough to search an index it built
+        reference = load_backend("torch", args.embedding_threads)
+        results["embedding_min_cosine_vs_torch"] = compare_embedders(embedder, reference, [row[2] for row in rows[:256]])
+        print(f"🔁 {args.embedding_backend} vs torch: min cosine {results['embedding_min_cosine_vs_torch']:.4f}")
+    results["quantization"] = bench_quantization(rows, embeddings, query_vectors, args.limit)
+    server.shutdown()
+
+    print(f"{'stage':<20}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'items/s':>12}")
+    for name, stats in stages.items():
+        print(f"{name:<20}{stats['count']:>8}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}"
+              f"{stats['p99_ms']:>10.2f}{stats.get('items_per_s', 0):>12.1f}")
+
+    print()
+    if isinstance(embedder, HashingEmbedder):
+        print("⚠️  Hashing embedder: its sparse vectors say nothing about real recall (binary drops to ~0); "
+              "install sentence-transformers to compare quantizations")
+    print(f"{'store':<20}{f'recall@{args.limit}':>10}{'resident KB':>14}{'p50 ms':>10}")
+    for name, stats in results["quantization"].items():
+        print(f"{name:<20}{stats['recall']:>10.3f}{stats['resident_bytes'] / 1024:>14.1f}{stats['p50_ms']:>10.2f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\n💾 Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
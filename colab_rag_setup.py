@@ -22,7 +22,6 @@ packages = [
     "sentence-transformers", 
     "transformers", 
     "torch", 
-    "chromadb", 
     "requests"
 ]
 
@@ -73,62 +72,42 @@ try:
 except:
     print("⚠️ Connection issue - run this cell again")
 
-# CELL 4: Setup Vector Database
-import chromadb
+# CELL 4: Setup Vector Store
 from sentence_transformers import SentenceTransformer
 from pathlib import Path
-import uuid
 
 print("🧠 Loading embedding model...")
 embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
 
-print("🗄️ Setting up vector database...")
-client = chromadb.Client()
-collection = client.create_collection("rag_documents")
+print("🗄️ Setting up vector store...")
+# The repo's in-process vector store: no database server needed
+from vectorstore import NumPyVectorStore
+store = NumPyVectorStore()
 
-def chunk_text(text, chunk_size=500, overlap=50):
-    words = text.split()
-    chunks = []
-    for i in range(0, len(words), chunk_size - overlap):
-        chunk = words[i:i+chunk_size]
-        if len(chunk) > 0:
-            chunks.append(" ".join(chunk))
-    return chunks
+# Same token-aware, structure-aware chunker as the encoder service
+sys.path.insert(0, "encoder")
+from chunking import chunk_file, make_token_counter
+count_tokens = make_token_counter(embedding_model.tokenizer)
 
 # Process documents
-documents = []
-metadatas = []
-ids = []
+rows = []
 
 data_path = Path("data")
 for filepath in data_path.glob("**/*"):
     if filepath.suffix in [".md", ".txt", ".py"]:
         try:
-            with open(filepath, "r", encoding="utf-8") as f:
-                text = f.read()
-            
-            if text.strip():
-                chunks = chunk_text(text)
-                for i, chunk in enumerate(chunks):
-                    documents.append(chunk)
-                    metadatas.append({
-                        "filename": filepath.name,
-                        "chunk_index": i
-                    })
-                    ids.append(f"{filepath.name}_{i}_{str(uuid.uuid4())[:8]}")
-                
-                print(f"✅ Processed {filepath.name}: {len(chunks)} chunks")
+            chunks = [chunk for chunk, _ in chunk_file(filepath, count_tokens)]
+            if chunks:
+                filename = filepath.relative_to(data_path).as_posix()
+                rows.extend((filename, i, chunk) for i, chunk in enumerate(chunks))
+                print(f"✅ Processed {filename}: {len(chunks)} chunks")
         except Exception as e:
             print(f"⚠️ Error processing {filepath.name}: {e}")
 
-# Add to vector database
-if documents:
-    collection.add(
-        documents=documents,
-        metadatas=metadatas,
-        ids=ids
-    )
-    print(f"✅ Vector database ready with {len(documents)} chunks!")
+# Embed and add to the vector store
+if rows:
+    store.add(rows, embedding_model.encode([row[2] for row in rows], batch_size=64))
+    print(f"✅ Vector store ready with {store.count()} chunks!")
 else:
     print("❌ No documents found!")
 
@@ -137,17 +116,14 @@ def query_rag(question, top_k=5, model="gemma:2b", verbose=False):
     """Query the RAG system"""
     print(f"🔍 Searching for: '{question}'")
     
-    # Query vector database
-    results = collection.query(
-        query_texts=[question],
-        n_results=top_k
-    )
+    # Query vector store
+    results = store.search(embedding_model.encode([question])[0], top_k)
     
-    if not results['documents'][0]:
+    if not results:
         return "❌ No relevant documents found."
     
     # Build context
-    context_chunks = results['documents'][0]
+    context_chunks = [result.content for result in results]
     context = "\\n---\\n".join(context_chunks)
     
     if verbose:
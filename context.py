@@ -0,0 +1,164 @@
+"""
+Context builder for rag.py.
+
+Retrieved chunks overlap (the encoder repeats a section heading and a few trailing
+lines at the start of each continuation chunk) and neighbouring chunks of the same
+file are often retrieved together, so joining them as-is sends the LLM the same
+text several times. Every prompt token costs prompt-eval time on a CPU model.
+
+build_context() merges runs of consecutive chunks from the same file, drops chunks
+that are near-duplicates of one already kept, and packs the rest, best first, into
+a token budget for the LLM model.
+"""
+
+import re
+
+SEPARATOR = "\n---\n"
+
+# Context windows of common Ollama models by family. Ollama itself runs every model
+# at 2048 tokens unless num_ctx is raised, so llm.py sends context_window() with each
+# request; unknown models get Ollama's default.
+CONTEXT_WINDOWS = {
+    "gemma": 8192,
+    "gemma2": 8192,
+    "llama3": 8192,
+    "llama2": 4096,
+    "mistral": 8192,
+    "phi3": 4096,
+    "qwen2": 8192,
+}
+DEFAULT_CONTEXT_WINDOW = 2048
+
+# Tokens kept free for the prompt template, the question and the answer
+RESERVED_TOKENS = 768
+
+# A chunk whose word shingles are at least this much contained in a kept chunk is dropped
+DUPLICATE_CONTAINMENT = 0.8
+
+_WORD_PIECE = re.compile(r"\w+|[^\w\s]")
+_WORD = re.compile(r"\w+")
+
+
+def estimate_tokens(text):
+    """Estimate LLM tokens without a tokenizer (words and punctuation, +30% for sub-words)."""
+    return int(len(_WORD_PIECE.findall(text)) * 1.3)
+
+
+def context_window(model_name, max_tokens=None):
+    """Context window (Ollama's num_ctx) to run the model with for this context budget."""
+    if max_tokens:
+        return max_tokens + RESERVED_TOKENS
+    family = model_name.split(":", 1)[0].lower()
+    return CONTEXT_WINDOWS.get(family, DEFAULT_CONTEXT_WINDOW)
+
+
+def context_budget(model_name, max_tokens=None):
+    """Tokens available for retrieved context with this model."""
+    if max_tokens:
+        return max_tokens
+    return max(context_window(model_name) - RESERVED_TOKENS, 256)
+
+
+def _continuation(previous, current):
+    """Return the part of current that does not repeat the end of the chunk before it."""
+    previous_lines = previous.splitlines()
+    current_lines = current.splitlines()
+    # Continuation chunks start with the section heading again
+    if previous_lines and len(current_lines) > 1 and current_lines[0] == previous_lines[0]:
+        current_lines = current_lines[1:]
+    for size in range(min(len(previous_lines), len(current_lines)), 0, -1):
+        if previous_lines[-size:] == current_lines[:size]:
+            return "\n" + "\n".join(current_lines[size:])
+
+    # Chunks written by the old word-window chunker overlap by words, not lines
+    previous_words, current_words = previous.split(), current.split()
+    for size in range(min(len(previous_words), len(current_words), 200), 0, -1):
+        if previous_words[-size:] == current_words[:size]:
+            return " " + " ".join(current_words[size:])
+    return "\n" + "\n".join(current_lines)
+
+
+def _shingles(text, size=3):
+    words = _WORD.findall(text.lower())
+    if len(words) < size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def merge_adjacent(chunks):
+    """Merge consecutive chunk_index runs of the same file.
+
+    chunks are (content, filename, chunk_index) in rank order; each merged block
+    takes the rank of its best chunk. Returns a list of block texts.
+    """
+    by_file = {}
+    for rank, (content, filename, chunk_index) in enumerate(chunks):
+        by_file.setdefault(filename, []).append((chunk_index, rank, content))
+
+    blocks = []
+    for members in by_file.values():
+        members.sort()
+        run_rank, run_text, last_index, last_content = None, None, None, None
+        for chunk_index, rank, content in members:
+            if run_text is not None and chunk_index == last_index + 1:
+                run_text = (run_text + _continuation(last_content, content)).rstrip()
+                run_rank = min(run_rank, rank)
+            else:
+                if run_text is not None:
+                    blocks.append((run_rank, run_text))
+                run_rank, run_text = rank, content
+            last_index, last_content = chunk_index, content
+        if run_text is not None:
+            blocks.append((run_rank, run_text))
+    blocks.sort(key=lambda block: block[0])
+    return [text for _, text in blocks]
+
+
+def drop_near_duplicates(blocks, threshold=DUPLICATE_CONTAINMENT):
+    """Keep blocks in order, skipping any mostly contained in one already kept."""
+    kept, kept_shingles = [], []
+    for text in blocks:
+        shingles = _shingles(text)
+        if shingles and any(len(shingles & other) >= threshold * len(shingles) for other in kept_shingles):
+            continue
+        kept.append(text)
+        kept_shingles.append(shingles)
+    return kept
+
+
+def pack(blocks, budget):
+    """Take blocks best first while they fit; the first is cut at a line boundary if it alone is too big."""
+    packed, used = [], 0
+    for text in blocks:
+        tokens = estimate_tokens(text)
+        if used + tokens <= budget:
+            packed.append(text)
+            used += tokens
+        elif not packed:
+            lines, kept = text.splitlines(), []
+            for line in lines:
+                line_tokens = estimate_tokens(line)
+                if used + line_tokens > budget:
+                    break
+                kept.append(line)
+                used += line_tokens
+            if kept:
+                packed.append("\n".join(kept))
+    return packed
+
+
+def build_context(chunks, model_name="gemma:2b", max_tokens=None):
+    """Return (context, stats) for (content, filename, chunk_index) chunks in rank order."""
+    tokens_in = sum(estimate_tokens(content) for content, _, _ in chunks)
+    blocks = drop_near_duplicates(merge_adjacent(chunks))
+    packed = pack(blocks, context_budget(model_name, max_tokens))
+    context = SEPARATOR.join(packed)
+    tokens_out = estimate_tokens(context)
+    stats = {
+        "chunks": len(chunks),
+        "blocks": len(packed),
+        "tokens_in": tokens_in,
+        "tokens_out": tokens_out,
+        "tokens_saved": max(tokens_in - tokens_out, 0),
+    }
+    return context, stats
@@ -0,0 +1,192 @@
+"""
+Embedding model backends shared by the encoder and the query path.
+
+load_embedder() returns an object with the slice of the SentenceTransformer
+interface the rest of the code uses: encode(texts, batch_size=...), tokenizer
+and max_seq_length. Every backend returns the same normalized mean-pooled
+vectors (to within float rounding, or ~1e-2 cosine for int8):
+
+- torch: SentenceTransformer run under torch.inference_mode(), with the number
+  of intra-op threads set explicitly.
+- onnx: the model's transformer exported once to ONNX and run with ONNX Runtime
+  (graph optimizations on, no autograd bookkeeping, no torch import on later
+  runs); pooling and normalization are done in NumPy.
+- onnx-int8: the same graph with its weights dynamically quantized to int8,
+  usually the fastest option on CPUs with AVX2/AVX512-VNNI.
+
+The backend and thread count come from EMBEDDING_BACKEND / EMBEDDING_THREADS
+(0 = the runtime's default, normally one thread per core). ONNX exports are
+cached under EMBEDDING_ONNX_DIR.
+"""
+
+import os
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+DEFAULT_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+DEFAULT_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+ONNX_CACHE_DIR = Path(os.getenv("EMBEDDING_ONNX_DIR", Path.home() / ".cache" / "rag-poc" / "onnx"))
+
+# ONNX opset for the export; 14 covers every op BERT-style encoders need
+ONNX_OPSET = 14
+
+
+def model_version(model_name, backend):
+    """Cache namespace for a model. torch and onnx give the same vectors; int8 weights do not."""
+    return f"{model_name}:int8" if backend == "onnx-int8" else model_name
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class TorchEmbedder:
+    """SentenceTransformer in inference mode; every other attribute is the model's."""
+
+    backend = "torch"
+
+    def __init__(self, model_name=EMBEDDING_MODEL, threads=DEFAULT_THREADS):
+        import torch
+        from sentence_transformers import SentenceTransformer
+        if threads:
+            torch.set_num_threads(threads)
+        self._torch = torch
+        self.model = SentenceTransformer(model_name, device="cpu")
+
+    def __getattr__(self, name):
+        if name == "model":
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        with self._torch.inference_mode():
+            return self.model.encode(sentences, batch_size=batch_size, **kwargs)
+
+
+def export_onnx(model_name=EMBEDDING_MODEL, cache_dir=ONNX_CACHE_DIR):
+    """Export the model's transformer and tokenizer to cache_dir/<model>; returns that directory.
+
+    Needs torch and sentence-transformers, but only the first time.
+    """
+    target = Path(cache_dir) / model_name.replace("/", "--")
+    if (target / "model.onnx").exists():
+        return target
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0].auto_model.eval()
+
+    class Encoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.transformer(input_ids=input_ids, attention_mask=attention_mask,
+                                    token_type_ids=token_type_ids, return_dict=False)[0]
+
+    logger.info(f"Exporting {model_name} to ONNX in {target}...")
+    target.mkdir(parents=True, exist_ok=True)
+    sample = model.tokenizer(["an example sentence"], return_tensors="pt")
+    names = ["input_ids", "attention_mask", "token_type_ids"]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    with torch.inference_mode():
+        torch.onnx.export(Encoder(), tuple(sample[name] for name in names), str(target / "model.tmp.onnx"),
+                          input_names=names, output_names=["last_hidden_state"], dynamic_axes=dynamic_axes,
+                          opset_version=ONNX_OPSET)
+    model.tokenizer.save_pretrained(str(target))
+    (target / "embedder.json").write_text(json.dumps({"model": model_name, "max_seq_length": model.max_seq_length}))
+    # Renamed last so an interrupted export is redone rather than half-used
+    (target / "model.tmp.onnx").rename(target / "model.onnx")
+    return target
+
+
+def quantize_onnx(directory):
+    """Write model-int8.onnx next to model.onnx with int8 dynamically quantized weights."""
+    source, target = Path(directory) / "model.onnx", Path(directory) / "model-int8.onnx"
+    if not target.exists():
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        logger.info(f"Quantizing {source} to int8...")
+        quantize_dynamic(str(source), str(target), weight_type=QuantType.QInt8)
+    return target
+
+
+class OnnxEmbedder:
+    """The exported transformer on ONNX Runtime, with mean pooling and normalization in NumPy."""
+
+    def __init__(self, model_name=EMBEDDING_MODEL, quantized=False, threads=DEFAULT_THREADS,
+                 cache_dir=ONNX_CACHE_DIR):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("The onnx embedding backends need onnxruntime: pip install onnxruntime") from e
+        from transformers import AutoTokenizer
+
+        directory = export_onnx(model_name, cache_dir)
+        path = quantize_onnx(directory) if quantized else directory / "model.onnx"
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        # Concurrent encode() calls (the encoder's encode workers) already run in parallel
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(str(directory))
+        self.max_seq_length = json.loads((directory / "embedder.json").read_text())["max_seq_length"]
+        self.backend = "onnx-int8" if quantized else "onnx"
+
+    def get_sentence_embedding_dimension(self):
+        return self.session.get_outputs()[0].shape[-1]
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, **kwargs):
+        """Embed a string or a list of strings, like SentenceTransformer.encode()."""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        out = np.empty((len(texts), 0), dtype=np.float32)
+        # Batch similar lengths together so little of each batch is padding
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        for start in range(0, len(texts), batch_size):
+            batch = order[start:start + batch_size]
+            encoded = self.tokenizer([texts[i] for i in batch], padding=True, truncation=True,
+                                     max_length=self.max_seq_length, return_tensors="np")
+            feed = {name: encoded[name].astype(np.int64) for name in self.input_names if name in encoded}
+            if "token_type_ids" in self.input_names and "token_type_ids" not in feed:
+                feed["token_type_ids"] = np.zeros_like(feed["input_ids"])
+            hidden = self.session.run(None, feed)[0]
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            if out.shape[1] == 0:
+                out = np.empty((len(texts), pooled.shape[1]), dtype=np.float32)
+            out[batch] = _normalize(pooled)
+        return out[0] if single else out
+
+
+def load_embedder(backend=None, threads=None, model_name=EMBEDDING_MODEL):
+    """Load the embedding model on the configured backend (EMBEDDING_BACKEND, default torch)."""
+    backend = backend or DEFAULT_BACKEND
+    threads = DEFAULT_THREADS if threads is None else threads
+    if backend == "torch":
+        return TorchEmbedder(model_name, threads)
+    if backend in ("onnx", "onnx-int8"):
+        return OnnxEmbedder(model_name, quantized=backend == "onnx-int8", threads=threads)
+    raise ValueError(f"Unknown embedding backend {backend!r}; expected one of {BACKENDS}")
+
+
+def compare_embedders(embedder, reference, texts):
+    """Lowest cosine similarity between two embedders' vectors for the same texts."""
+    a = _normalize(np.asarray(embedder.encode(texts), dtype=np.float32))
+    b = _normalize(np.asarray(reference.encode(texts), dtype=np.float32))
+    return float((a * b).sum(axis=1).min())
@@ -0,0 +1,188 @@
+"""Token-aware, structure-aware text chunking used by the encoder (and the Colab notebook).
+
+Chunks are sized in model tokens so they fit the embedding model's window
+(all-MiniLM-L6-v2 truncates at 256 word-pieces, including [CLS] and [SEP]);
+anything beyond that would be stored but never seen by the model. A new chunk
+starts at every Markdown heading and Python def/class, and long sections are
+packed line by line with a small token overlap. Lines are consumed in one pass,
+so a file can be chunked while it is being read.
+"""
+
+import re
+import math
+from itertools import islice
+
+# all-MiniLM-L6-v2 max_seq_length (256) minus [CLS] and [SEP]
+DEFAULT_MAX_TOKENS = 254
+DEFAULT_OVERLAP_TOKENS = 32
+
+# Lines are tokenized in blocks this size, which is much faster than one call per line
+_TOKENIZE_BLOCK = 256
+
+_MARKDOWN_HEADING = re.compile(r"^#{1,6}\s")
+_MARKDOWN_FENCE = re.compile(r"^\s*(```|~~~)")
+_PYTHON_DEFINITION = re.compile(r"^(?: {4})?(?:@|(?:async\s+)?def\s|class\s)")
+_WORD_PIECE = re.compile(r"\w+|[^\w\s]")
+
+
+def approx_token_counts(texts):
+    """Estimate word-piece counts without a tokenizer (words and punctuation, +30% for sub-words).
+
+    Rounded up, so per-word counts summed by _split_long_line never undercount the joined text.
+    """
+    return [math.ceil(len(_WORD_PIECE.findall(text)) * 1.3) for text in texts]
+
+
+def make_token_counter(tokenizer):
+    """Wrap a Hugging Face tokenizer as a batched counter: list of str -> list of token counts."""
+    def count_tokens(texts):
+        encoded = tokenizer(list(texts), add_special_tokens=False)
+        return [len(ids) for ids in encoded["input_ids"]]
+    return count_tokens
+
+
+def kind_for(path):
+    """Pick the boundary rules for a file from its suffix."""
+    suffix = str(path).rsplit(".", 1)[-1].lower() if "." in str(path) else ""
+    return {"md": "markdown", "py": "python"}.get(suffix, "text")
+
+
+def _boundaries(kind):
+    """Return a predicate telling whether a line starts a new section."""
+    if kind == "markdown":
+        in_fence = False
+
+        def is_boundary(line):
+            nonlocal in_fence
+            if _MARKDOWN_FENCE.match(line):
+                in_fence = not in_fence
+                return False
+            return not in_fence and bool(_MARKDOWN_HEADING.match(line))
+        return is_boundary
+
+    if kind == "python":
+        after_decorator = False
+
+        def is_boundary(line):
+            nonlocal after_decorator
+            if not _PYTHON_DEFINITION.match(line):
+                after_decorator = False
+                return False
+            # A def directly under its decorators belongs to the decorator's section
+            starts = not after_decorator
+            after_decorator = line.lstrip().startswith("@")
+            return starts
+        return is_boundary
+
+    return lambda line: False
+
+
+def _split_long_line(line, count_tokens, max_tokens):
+    """Break a single line that exceeds the budget into word groups that fit."""
+    words = line.split()
+    pieces, current, current_tokens = [], [], 0
+    for word, tokens in zip(words, count_tokens(words)):
+        if current and current_tokens + tokens > max_tokens:
+            pieces.append((" ".join(current), current_tokens))
+            current, current_tokens = [], 0
+        current.append(word)
+        current_tokens += tokens
+    if current:
+        pieces.append((" ".join(current), current_tokens))
+    return pieces
+
+
+def iter_chunks(lines, kind="text", count_tokens=None, max_tokens=DEFAULT_MAX_TOKENS,
+                overlap_tokens=DEFAULT_OVERLAP_TOKENS):
+    """Yield (chunk_text, token_count) from an iterable of lines in a single pass.
+
+    A chunk never crosses a section boundary. Within a section, lines are packed
+    until the next one would exceed max_tokens; the following chunk then repeats
+    the section's heading line and up to overlap_tokens of trailing lines.
+    """
+    count_tokens = count_tokens or approx_token_counts
+    is_boundary = _boundaries(kind)
+    current = []          # [(line, tokens)]
+    current_tokens = 0
+    has_body = False      # whether current holds anything besides section headings
+    heading = None        # first line of the current section, repeated in its continuation chunks
+
+    def emit():
+        text = "".join(line for line, _ in current).strip()
+        return (text, current_tokens) if text else None
+
+    lines = iter(lines)
+    while True:
+        block = list(islice(lines, _TOKENIZE_BLOCK))
+        if not block:
+            break
+        for line, tokens in zip(block, count_tokens(block)):
+            entry = (line, tokens)
+            if is_boundary(line):
+                # Headings with no body of their own (e.g. "## Setup" then "### Docker") stay as a prefix
+                if has_body:
+                    chunk = emit()
+                    if chunk:
+                        yield chunk
+                    current, current_tokens = [], 0
+                heading = entry if tokens < max_tokens // 4 else None
+                has_body = False
+            elif line.strip():
+                has_body = True
+
+            if tokens > max_tokens:
+                chunk = emit()
+                if chunk:
+                    yield chunk
+                for piece in _split_long_line(line, count_tokens, max_tokens):
+                    yield piece
+                current, current_tokens, has_body = [], 0, False
+                continue
+
+            if current and current_tokens + tokens > max_tokens:
+                chunk = emit()
+                if chunk:
+                    yield chunk
+                # Carry the section heading and a token-bounded tail into the next chunk
+                tail, tail_tokens = [], 0
+                for previous in reversed(current):
+                    if previous is heading or tail_tokens + previous[1] > overlap_tokens:
+                        break
+                    tail.insert(0, previous)
+                    tail_tokens += previous[1]
+                current = ([heading] if heading else []) + tail
+                current_tokens = sum(t for _, t in current)
+                if current_tokens + tokens > max_tokens:
+                    current, current_tokens = [], 0
+
+            current.append(entry)
+            current_tokens += tokens
+
+    chunk = emit()
+    if chunk:
+        yield chunk
+
+
+def chunk_text(text, kind="text", count_tokens=None, max_tokens=DEFAULT_MAX_TOKENS,
+               overlap_tokens=DEFAULT_OVERLAP_TOKENS):
+    """Split text into token-bounded chunks along its structure."""
+    return [chunk for chunk, _ in iter_chunks(text.splitlines(keepends=True), kind, count_tokens,
+                                               max_tokens, overlap_tokens)]
+
+
+def iter_file_lines(path, max_line_chars=1 << 16, buffer_size=1 << 20):
+    """Yield a file's lines through a buffered reader, splitting lines longer than max_line_chars.
+
+    Memory stays bounded even for a huge single-line (e.g. minified or generated) file.
+    """
+    with open(path, "r", encoding="utf-8", buffering=buffer_size) as f:
+        while True:
+            line = f.readline(max_line_chars)
+            if not line:
+                return
+            yield line
+
+
+def chunk_file(path, count_tokens=None, max_tokens=DEFAULT_MAX_TOKENS, overlap_tokens=DEFAULT_OVERLAP_TOKENS):
+    """Lazily yield (chunk_text, token_count) while streaming a file."""
+    yield from iter_chunks(iter_file_lines(path), kind_for(path), count_tokens, max_tokens, overlap_tokens)
@@ -1,25 +1,100 @@
 import os
+import sys
 import time
+import hashlib
+import argparse
+import math
+from contextlib import nullcontext
+from datetime import datetime, timezone
 import psycopg2
-from sentence_transformers import SentenceTransformer
+from psycopg2.extras import execute_values
 from pathlib import Path
 import logging
 
+# vectorstore.py, embedders.py and metrics.py live at the repository root (the Docker image copies them next to this file)
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from embedders import BACKENDS, DEFAULT_BACKEND, DEFAULT_THREADS, EMBEDDING_MODEL, load_embedder, model_version
+from embedding_cache import EmbeddingCache
+from metrics import METRICS, profile, span
+from pipeline import ChangedFile, IngestPipeline
+from vectorstore import PG_QUANTIZED_EXPRESSIONS, NumPyVectorStore, PgVectorStore, file_metadata
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+SUPPORTED_SUFFIXES = [".md", ".py", ".txt"]
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Chunk and embed documents into pgvector')
+    parser.add_argument('--data-dir', default=os.getenv("DATA_DIR", "/app/data"),
+                        help='Directory containing the documents (default: /app/data)')
+    parser.add_argument('--full', action='store_true', default=os.getenv("EMBED_FULL_REINDEX") == "1",
+                        help='Re-embed every file, even if it is unchanged since the last run')
+    parser.add_argument('--commit-rows', type=int, default=int(os.getenv("EMBED_COMMIT_ROWS", "5000")),
+                        help='Number of chunks to buffer per COPY/commit (default: 5000)')
+    parser.add_argument('--batch-size', type=int, default=int(os.getenv("EMBED_BATCH_SIZE", "32")),
+                        help='Number of chunks per model forward pass (default: 32)')
+    parser.add_argument('--queue-chunks', type=int, default=int(os.getenv("EMBED_QUEUE_CHUNKS", "1024")),
+                        help='Chunks collected across files before encoding (default: 1024)')
+    parser.add_argument('--read-workers', type=int, default=int(os.getenv("EMBED_READ_WORKERS", "4")),
+                        help='Threads reading and decoding files (default: 4)')
+    parser.add_argument('--chunk-workers', type=int, default=int(os.getenv("EMBED_CHUNK_WORKERS", "2")),
+                        help='Processes chunking and tokenizing text, 0 to chunk in-thread (default: 2)')
+    parser.add_argument('--encode-workers', type=int, default=int(os.getenv("EMBED_ENCODE_WORKERS", "1")),
+                        help='Threads running the embedding model (default: 1)')
+    parser.add_argument('--queue-depth', type=int, default=int(os.getenv("EMBED_QUEUE_DEPTH", "8")),
+                        help='Maximum items waiting between pipeline stages (default: 8)')
+    parser.add_argument('--stream-threshold-mb', type=float, default=float(os.getenv("EMBED_STREAM_THRESHOLD_MB", "8")),
+                        help='Files at least this large are streamed in bounded batches (default: 8)')
+    parser.add_argument('--embedding-backend', choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help=f'Runtime for the embedding model: torch, onnx or onnx-int8 (default: {DEFAULT_BACKEND})')
+    parser.add_argument('--embedding-threads', type=int, default=DEFAULT_THREADS,
+                        help='CPU threads per model forward pass, 0 for the runtime default (default: 0)')
+    parser.add_argument('--no-embedding-cache', dest='embedding_cache', action='store_false',
+                        default=os.getenv("EMBED_CACHE", "1") != "0",
+                        help='Embed every chunk instead of reusing cached embeddings of identical text')
+    parser.add_argument('--prune-embedding-cache', action='store_true',
+                        help='Delete cached embeddings made by other models or backends')
+    parser.add_argument('--index-type', choices=['hnsw', 'ivfflat'], default=os.getenv("VECTOR_INDEX_TYPE", "hnsw"),
+                        help='Vector index built after ingest (default: hnsw)')
+    parser.add_argument('--hnsw-m', type=int, default=int(os.getenv("HNSW_M", "16")),
+                        help='HNSW max connections per layer (default: 16)')
+    parser.add_argument('--hnsw-ef-construction', type=int, default=int(os.getenv("HNSW_EF_CONSTRUCTION", "64")),
+                        help='HNSW candidate list size while building (default: 64)')
+    parser.add_argument('--ivfflat-lists', type=int, default=int(os.getenv("IVFFLAT_LISTS", "0")),
+                        help='IVFFlat lists, 0 to size from the row count (default: 0)')
+    parser.add_argument('--quantization', choices=['none', 'halfvec', 'binary'],
+                        default=os.getenv("VECTOR_QUANTIZATION", "none"),
+                        help='Index a compact copy of the embeddings; searches re-rank on the full vectors (default: none)')
+    parser.add_argument('--reindex', action='store_true',
+                        help='Rebuild the vector index even if its settings are unchanged')
+    parser.add_argument('--export-numpy', metavar='DIR',
+                        help='Also save every chunk to a NumPy vector store directory (for rag.py --store DIR)')
+    parser.add_argument('--export-dtype', choices=['float32', 'float16'], default='float32',
+                        help='Embedding precision of the exported store (default: float32)')
+    parser.add_argument('--metrics', metavar='FILE', default=os.getenv("EMBED_METRICS_FILE"),
+                        help='Write per-stage latency metrics on exit: JSON for *.json, Prometheus text otherwise')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Run under cProfile and write the stats to FILE and the stage spans to FILE.trace.json')
+    return parser.parse_args()
+
+def connect_to_database():
+    """Open a new connection using the POSTGRES_* environment variables."""
+    return psycopg2.connect(
+        dbname=os.getenv("POSTGRES_DB", "ragdb"),
+        user=os.getenv("POSTGRES_USER", "rag"),
+        password=os.getenv("POSTGRES_PASSWORD", "ragpass"),
+        host=os.getenv("POSTGRES_HOST", "pgvector"),
+        port=5432
+    )
+
 def wait_for_db(max_retries=30, retry_interval=2):
     """Wait for database to be ready with connection retries."""
     for attempt in range(max_retries):
         try:
-            conn = psycopg2.connect(
-                dbname=os.getenv("POSTGRES_DB", "ragdb"),
-                user=os.getenv("POSTGRES_USER", "rag"),
-                password=os.getenv("POSTGRES_PASSWORD", "ragpass"),
-                host=os.getenv("POSTGRES_HOST", "pgvector"),
-                port=5432
-            )
+            conn = connect_to_database()
             conn.close()
             logger.info("Database connection successful!")
             return True
@@ -30,17 +105,327 @@ def wait_for_db(max_retries=30, retry_interval=2):
     logger.error("Could not connect to database after maximum retries")
     return False
 
-def chunk_text(text, chunk_size=500, overlap=50):
-    """Split text into overlapping chunks."""
-    words = text.split()
-    chunks = []
-    for i in range(0, len(words), chunk_size - overlap):
-        chunk = words[i:i+chunk_size]
-        if len(chunk) > 0:  # Avoid empty chunks
-            chunks.append(" ".join(chunk))
-    return chunks
+def file_hash(filepath, block_size=1 << 20):
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest(cur):
+    """Load the per-file manifest as {filename: (content_hash, mtime, size_bytes)}."""
+    cur.execute("SELECT filename, content_hash, mtime, size_bytes FROM document_files;")
+    return {filename: (content_hash, mtime, size) for filename, content_hash, mtime, size in cur.fetchall()}
+
+def indexed_filenames(cur):
+    """Return every filename that currently has chunks or a manifest entry."""
+    cur.execute("SELECT filename FROM document_files UNION SELECT DISTINCT filename FROM documents;")
+    return {row[0] for row in cur.fetchall()}
+
+def upsert_manifest(cur, rows):
+    """Insert or update (filename, content_hash, mtime, size_bytes, chunk_count) manifest rows."""
+    execute_values(cur, """
+        INSERT INTO document_files (filename, content_hash, mtime, size_bytes, chunk_count)
+        VALUES %s
+        ON CONFLICT (filename) DO UPDATE
+        SET content_hash = EXCLUDED.content_hash, mtime = EXCLUDED.mtime,
+            size_bytes = EXCLUDED.size_bytes, chunk_count = EXCLUDED.chunk_count,
+            indexed_at = NOW();
+    """, rows)
+
+class DocumentWriter:
+    """Buffer per-file chunk swaps and write them with one COPY per transaction.
+
+    Each flush deletes the old chunks of every buffered file, streams the new rows
+    into the vector store with COPY ... FROM STDIN (FORMAT binary) and upserts the
+    manifest, all in one transaction, so a file is never visible half-written.
+    files_written and chunks_written count what the flushes committed.
+
+    conn is the store's Postgres connection; the manifest table is written on it
+    so it commits together with the chunks, which ties the writer to PgVectorStore.
+    """
+
+    def __init__(self, store, conn, commit_rows=5000):
+        self.store = store
+        self.conn = conn
+        self.commit_rows = commit_rows
+        self.files_written = 0
+        self.chunks_written = 0
+        self._reset()
+
+    def _reset(self):
+        self.rows = []
+        self.embeddings = []
+        self.filenames = []
+        self.metadata = {}
+        self.manifest_rows = []
+
+    def replace_file(self, filename, chunks, embeddings, content_hash, mtime, size):
+        """Queue a file's new chunks, flushing once the commit size is reached."""
+        self.rows.extend((filename, i, chunk) for i, chunk in enumerate(chunks))
+        self.embeddings.extend(embeddings)
+        self.filenames.append(filename)
+        self.metadata[filename] = file_metadata(filename, mtime)
+        self.manifest_rows.append((filename, content_hash, mtime, size, len(chunks)))
+        if len(self.rows) >= self.commit_rows:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered files in a single transaction.
+
+        If that fails, each file is retried in a transaction of its own, so a bad
+        file (e.g. text Postgres rejects) is skipped without losing the others.
+        """
+        if not self.filenames:
+            return
+        try:
+            self._write(self.filenames, self.rows, self.embeddings, self.metadata, self.manifest_rows)
+        except Exception as e:
+            if len(self.filenames) == 1:
+                logger.error(f"Failed to write {self.filenames[0]}: {e}")
+                return
+            logger.warning(f"Failed to write {len(self.filenames)} files together ({e}), retrying one at a time")
+            offset = 0
+            for manifest_row in self.manifest_rows:
+                filename, count = manifest_row[0], manifest_row[4]
+                try:
+                    self._write([filename], self.rows[offset:offset + count], self.embeddings[offset:offset + count],
+                                {filename: self.metadata[filename]}, [manifest_row])
+                except Exception as e:
+                    logger.error(f"Failed to write {filename}: {e}")
+                offset += count
+        finally:
+            self._reset()
+
+    def _write(self, filenames, rows, embeddings, metadata, manifest_rows):
+        """Swap the chunks of these files in one transaction, rolling it back on failure."""
+        try:
+            with span("insert"):
+                self.store.delete(filenames)
+                self.store.add(rows, embeddings, metadata)
+                upsert_manifest(self.conn.cursor(), manifest_rows)
+            with span("commit"):
+                self.store.commit()
+        except Exception:
+            self.store.rollback()
+            raise
+        self.files_written += len(filenames)
+        self.chunks_written += len(rows)
+        METRICS.inc("files_embedded_total", len(filenames))
+        METRICS.inc("chunks_embedded_total", len(rows))
+        logger.info(f"Committed {len(rows)} chunks from {len(filenames)} files")
+
+    def replace_file_streaming(self, filename, batches, content_hash, mtime, size):
+        """Swap a large file's chunks in one transaction, COPYing each batch as it arrives.
+
+        batches yields (chunks, embeddings); only one batch is held in memory at a time.
+        Returns the number of chunks written.
+        """
+        self.flush()
+        chunk_index = 0
+        metadata = {filename: file_metadata(filename, mtime)}
+        try:
+            with span("insert"):
+                self.store.delete([filename])
+            for chunks, embeddings in batches:
+                rows = [(filename, chunk_index + i, chunk) for i, chunk in enumerate(chunks)]
+                with span("insert"):
+                    self.store.add(rows, embeddings, metadata)
+                chunk_index += len(rows)
+                logger.info(f"Streamed {chunk_index} chunks of {filename} so far")
+            with span("insert"):
+                upsert_manifest(self.conn.cursor(), [(filename, content_hash, mtime, size, chunk_index)])
+            with span("commit"):
+                self.store.commit()
+            METRICS.inc("files_embedded_total")
+            METRICS.inc("chunks_embedded_total", chunk_index)
+            logger.info(f"Committed {chunk_index} chunks from {filename}")
+            return chunk_index
+        except Exception:
+            self.store.rollback()
+            logger.error(f"Failed to write file: {filename}")
+            raise
+
+def open_embedding_cache(args):
+    """Open the embedding cache on its own connection; None when disabled or unavailable."""
+    if not args.embedding_cache:
+        return None
+    try:
+        cache = EmbeddingCache(connect_to_database(), model_version(EMBEDDING_MODEL, args.embedding_backend))
+    except Exception as e:
+        logger.warning(f"Embedding cache unavailable, embedding every chunk: {e}")
+        return None
+    if args.prune_embedding_cache:
+        logger.info(f"Pruned {cache.prune()} cached embeddings of other model versions")
+    return cache
+
+def plan_changes(conn, data_path, manifest):
+    """Walk the data directory and return (changed_files, seen_filenames, skipped_count).
+
+    Files are identified by their path relative to the data directory, so equal names in
+    different folders are separate documents.
+
+    Files whose mtime and size match the manifest are skipped without being read; files
+    whose content hash still matches only get their manifest mtime refreshed.
+    """
+    changed = []
+    seen = set()
+    skipped = 0
+    for filepath in sorted(data_path.glob("**/*")):
+        if not filepath.is_file() or filepath.suffix not in SUPPORTED_SUFFIXES:
+            continue
+        
+        filename = filepath.relative_to(data_path).as_posix()
+        seen.add(filename)
+        try:
+            stat = filepath.stat()
+            mtime = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
+            previous = manifest.get(filename)
+            if previous and previous[1] == mtime and previous[2] == stat.st_size:
+                skipped += 1
+                continue
+            
+            content_hash = file_hash(filepath)
+            if previous and previous[0] == content_hash:
+                touch_manifest(conn, filename, mtime, stat.st_size)
+                skipped += 1
+                continue
+            
+            changed.append(ChangedFile(filepath, filename, content_hash, mtime, stat.st_size))
+        except Exception as e:
+            logger.error(f"Error checking {filename}: {e}")
+    return changed, seen, skipped
+
+def touch_manifest(conn, filename, mtime, size):
+    """Record a new mtime for a file whose content hash did not change."""
+    cur = conn.cursor()
+    cur.execute("UPDATE document_files SET mtime = %s, size_bytes = %s WHERE filename = %s;",
+                (mtime, size, filename))
+    conn.commit()
+
+def remove_file(store, conn, filename):
+    """Delete a removed file's chunks and manifest entry in a single transaction on the store's conn."""
+    try:
+        store.delete([filename])
+        conn.cursor().execute("DELETE FROM document_files WHERE filename = %s;", (filename,))
+        store.commit()
+    except Exception:
+        store.rollback()
+        raise
+
+def export_numpy_store(store, path, dtype="float32", quantization="none"):
+    """Copy every stored chunk into a NumPyVectorStore directory for Postgres-free querying."""
+    exported = NumPyVectorStore(dtype=dtype, quantization=quantization)
+    for rows, embeddings, metadata in store.iter_chunks():
+        exported.add(rows, embeddings, metadata)
+    exported.save(path)
+    return exported.count()
+
+VECTOR_INDEX = "documents_embedding_idx"
+
+# Operator class for each indexed form of the embedding
+INDEX_OPCLASSES = {"none": "vector_cosine_ops", "halfvec": "halfvec_cosine_ops", "binary": "bit_hamming_ops"}
+
+def ivfflat_lists_for(row_count):
+    """pgvector's sizing guideline: rows / 1000 up to 1M rows, sqrt(rows) beyond."""
+    if row_count > 1_000_000:
+        return int(math.sqrt(row_count))
+    return max(1, row_count // 1000)
+
+def vector_index_spec(args, row_count):
+    """Return (spec, index_sql) for the configured index; spec is stored as the index comment."""
+    quantization = getattr(args, "quantization", "none")
+    # Quantized indexes are built on the same expression PgVectorStore orders its candidates by
+    column = "embedding" if quantization == "none" else PG_QUANTIZED_EXPRESSIONS[quantization][0]
+    opclass = INDEX_OPCLASSES[quantization]
+    if args.index_type == "hnsw":
+        spec = f"hnsw m={args.hnsw_m} ef_construction={args.hnsw_ef_construction}"
+        sql = (f"USING hnsw ({column} {opclass}) "
+               f"WITH (m = {args.hnsw_m}, ef_construction = {args.hnsw_ef_construction})")
+    else:
+        lists = args.ivfflat_lists or ivfflat_lists_for(row_count)
+        spec = f"ivfflat lists={lists}"
+        sql = f"USING ivfflat ({column} {opclass}) WITH (lists = {lists})"
+    if quantization != "none":
+        spec += f" quantization={quantization}"
+    return spec, sql
+
+def parse_index_spec(spec):
+    """Split a spec like "ivfflat lists=100 quantization=binary" into (type, {setting: value})."""
+    index_type, *settings = spec.split()
+    return index_type, dict(setting.split("=", 1) for setting in settings)
+
+def needs_rebuild(current_spec, spec, args):
+    """Decide whether the existing index has to be rebuilt."""
+    if args.reindex or current_spec is None:
+        return True
+    current_type, current = parse_index_spec(current_spec)
+    wanted_type, wanted = parse_index_spec(spec)
+    if args.index_type == "ivfflat" and not args.ivfflat_lists and current_type == "ivfflat":
+        # IVFFlat centroids do not adapt to new rows; retrain once the ideal list count drifts 2x
+        current_lists = int(current.pop("lists"))
+        wanted_lists = int(wanted.pop("lists"))
+        if not (current_lists / 2 <= wanted_lists <= current_lists * 2):
+            return True
+        return current != wanted
+    return current_spec != spec
+
+def ensure_vector_index(conn, args):
+    """Build or rebuild the vector index after ingest, without leaving the table unindexed."""
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM documents;")
+    row_count = cur.fetchone()[0]
+    cur.execute("SELECT obj_description(to_regclass(%s), 'pg_class'), to_regclass(%s) IS NOT NULL;",
+                (VECTOR_INDEX, VECTOR_INDEX))
+    current_spec, exists = cur.fetchone()
+    conn.commit()
+    if not exists:
+        current_spec = None
+
+    if row_count == 0:
+        logger.info("No documents stored, skipping vector index build")
+        return
+
+    spec, index_sql = vector_index_spec(args, row_count)
+    if not needs_rebuild(current_spec, spec, args):
+        logger.info(f"Vector index up to date ({current_spec})")
+        return
+
+    logger.info(f"Building vector index ({spec}) over {row_count} chunks...")
+    conn.autocommit = True
+    try:
+        # Build the replacement concurrently so queries keep using the old index meanwhile
+        cur.execute(f"SET maintenance_work_mem = '{os.getenv('INDEX_MAINTENANCE_WORK_MEM', '512MB')}';")
+        cur.execute(f"DROP INDEX IF EXISTS {VECTOR_INDEX}_new;")
+        cur.execute(f"CREATE INDEX CONCURRENTLY {VECTOR_INDEX}_new ON documents {index_sql};")
+    finally:
+        conn.autocommit = False
+    try:
+        cur.execute(f"DROP INDEX IF EXISTS {VECTOR_INDEX};")
+        cur.execute(f"ALTER INDEX {VECTOR_INDEX}_new RENAME TO {VECTOR_INDEX};")
+        cur.execute(f"COMMENT ON INDEX {VECTOR_INDEX} IS %s;", (spec,))
+        cur.execute("ANALYZE documents;")
+        conn.commit()
+        logger.info("Vector index ready")
+    except Exception:
+        conn.rollback()
+        raise
 
 def main():
+    args = parse_arguments()
+    try:
+        with profile(args.profile) if args.profile else nullcontext():
+            run(args)
+    finally:
+        if args.metrics:
+            METRICS.write(args.metrics)
+            logger.info(f"Metrics written to {args.metrics}")
+        for line in METRICS.summary():
+            logger.info(f"Stage {line}")
+
+def run(args):
+    """Embed new and changed files, remove deleted ones and refresh the vector index."""
     logger.info("Starting document embedding process...")
     
     # Wait for database to be ready
@@ -49,94 +434,119 @@ def main():
     
     # Connect to database
     try:
-        conn = psycopg2.connect(
-            dbname=os.getenv("POSTGRES_DB", "ragdb"),
-            user=os.getenv("POSTGRES_USER", "rag"),
-            password=os.getenv("POSTGRES_PASSWORD", "ragpass"),
-            host=os.getenv("POSTGRES_HOST", "pgvector"),
-            port=5432
-        )
+        conn = connect_to_database()
         cur = conn.cursor()
         logger.info("Connected to database successfully")
     except Exception as e:
         logger.error(f"Failed to connect to database: {e}")
         return
 
-    # Clear existing documents (for fresh start)
+    # Load what was indexed on previous runs so unchanged files can be skipped
     try:
-        cur.execute("DELETE FROM documents;")
+        manifest = {} if args.full else load_manifest(cur)
+        previously_indexed = indexed_filenames(cur)
         conn.commit()
-        logger.info("Cleared existing documents")
     except Exception as e:
-        logger.error(f"Failed to clear documents: {e}")
+        logger.error(f"Failed to load document manifest: {e}")
+        # Missing tables, functions and triggers are created by re-running the script
+        logger.info("Apply the latest schema: docker compose exec -T pgvector psql -U rag -d ragdb "
+                    "< pgvector/init.sql (or recreate the volume: docker compose down -v)")
         return
-
-    # Initialize the sentence transformer model
-    logger.info("Loading sentence transformer model...")
     try:
-        model = SentenceTransformer('all-MiniLM-L6-v2')
-        logger.info("Model loaded successfully")
+        # Fails on tables created before chunks carried file metadata
+        cur.execute("SELECT file_type, tags, mtime, content_tsv FROM documents LIMIT 0;")
     except Exception as e:
-        logger.error(f"Failed to load model: {e}")
+        logger.error(f"The documents table predates the current schema: {e}")
+        # CREATE TABLE IF NOT EXISTS leaves an existing table as it is, so init.sql cannot add the columns
+        logger.info("Recreate the volume and re-index: docker compose down -v")
         return
+    mode = "full" if args.full else "incremental"
+    logger.info(f"Running {mode} re-index ({len(previously_indexed)} files currently indexed)")
 
     # Process documents
-    data_path = Path("/app/data")
+    data_path = Path(args.data_dir)
     if not data_path.exists():
         logger.error("Data directory not found")
         return
 
+    changed_files, seen_files, skipped_files = plan_changes(conn, data_path, manifest)
+    logger.info(f"{len(changed_files)} files to embed, {skipped_files} unchanged")
+
+    store = PgVectorStore(conn, quantization=args.quantization)
+    writer = DocumentWriter(store, conn, args.commit_rows)
     processed_files = 0
     total_chunks = 0
-    
-    for filepath in data_path.glob("**/*"):
-        if not filepath.is_file() or filepath.suffix not in [".md", ".py", ".txt"]:
-            continue
-            
+    cache = open_embedding_cache(args) if changed_files or args.prune_embedding_cache else None
+
+    if changed_files:
+        # Load the model only when there is something to embed
+        logger.info(f"Loading {EMBEDDING_MODEL} on the {args.embedding_backend} backend...")
         try:
-            logger.info(f"Processing file: {filepath.name}")
-            
-            with open(filepath, "r", encoding="utf-8") as f:
-                text = f.read()
-            
-            if not text.strip():
-                logger.warning(f"Empty file skipped: {filepath.name}")
-                continue
-            
-            chunks = chunk_text(text)
-            logger.info(f"Created {len(chunks)} chunks from {filepath.name}")
-            
-            if chunks:
-                embeddings = model.encode(chunks)
-                
-                for i, (chunk, emb) in enumerate(zip(chunks, embeddings)):
-                    cur.execute(
-                        "INSERT INTO documents (filename, chunk_index, content, embedding) VALUES (%s, %s, %s, %s)",
-                        (filepath.name, i, chunk, emb.tolist())
-                    )
-                
-                conn.commit()
-                processed_files += 1
-                total_chunks += len(chunks)
-                logger.info(f"Successfully processed {filepath.name}")
-            
+            with span("model_load", backend=args.embedding_backend):
+                model = load_embedder(args.embedding_backend, args.embedding_threads)
+            logger.info("Model loaded successfully")
         except Exception as e:
-            logger.error(f"Error processing {filepath.name}: {e}")
-            continue
+            logger.error(f"Failed to load model: {e}")
+            if cache:
+                cache.close()
+            return
+
+        pipeline = IngestPipeline(
+            model, writer,
+            batch_size=args.batch_size,
+            queue_chunks=args.queue_chunks,
+            read_workers=args.read_workers,
+            chunk_workers=args.chunk_workers,
+            encode_workers=args.encode_workers,
+            queue_depth=args.queue_depth,
+            stream_threshold=int(args.stream_threshold_mb * 1024 * 1024),
+            cache=cache
+        )
+        try:
+            processed_files, total_chunks = pipeline.run(changed_files)
+        except Exception as e:
+            logger.error(f"Ingest pipeline failed: {e}")
+
+    if cache:
+        if cache.hits or cache.misses:
+            logger.info(f"Embedding cache: {cache.hits} of {cache.hits + cache.misses} chunks reused "
+                        f"({cache.hit_rate():.1%} hit rate)")
+        cache.close()
+
+    removed_files = 0
+    for filename in sorted(previously_indexed - seen_files):
+        try:
+            remove_file(store, conn, filename)
+            removed_files += 1
+            logger.info(f"Removed chunks for deleted file: {filename}")
+        except Exception as e:
+            logger.error(f"Error removing {filename}: {e}")
+
+    try:
+        ensure_vector_index(conn, args)
+    except Exception as e:
+        logger.error(f"Failed to build vector index: {e}")
 
     logger.info(f"Embedding process completed!")
     logger.info(f"Processed {processed_files} files with {total_chunks} total chunks")
+    logger.info(f"Skipped {skipped_files} unchanged files, removed {removed_files} deleted files")
     
     # Verify the data was inserted
     try:
-        cur.execute("SELECT COUNT(*) FROM documents;")
-        count = cur.fetchone()[0]
+        count = store.count()
         logger.info(f"Verified: {count} documents stored in database")
     except Exception as e:
         logger.error(f"Failed to verify document count: {e}")
     
+    if args.export_numpy:
+        try:
+            exported = export_numpy_store(store, args.export_numpy, args.export_dtype, args.quantization)
+            logger.info(f"Exported {exported} chunks to {args.export_numpy}")
+        except Exception as e:
+            logger.error(f"Failed to export NumPy store: {e}")
+    
     conn.close()
     logger.info("Database connection closed")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,106 @@
+"""
+Content-addressed embedding cache for the encoder.
+
+Editing a file moves chunk boundaries, but most of its chunks come out with the
+same text as before. Licence headers, repeated README sections and vendored
+files also produce the same chunk text many times across the corpus. Each
+embedding is therefore stored in the embedding_cache table under a hash of
+(model version, normalized chunk text). encode_chunks() looks up a whole batch in
+one query and runs the model only on the misses, each distinct text once.
+
+Entries are namespaced by model version, so switching models never serves a
+vector from another embedding space; prune() drops every other version's entries.
+"""
+
+import re
+import json
+import hashlib
+import logging
+import threading
+
+import numpy as np
+from psycopg2 import Binary
+from psycopg2.extras import execute_values
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Keys looked up per query, to keep the ANY(...) array reasonably sized
+LOOKUP_BATCH = 1000
+
+
+def normalize_chunk(text):
+    """Collapse whitespace runs: WordPiece tokenizers split on whitespace, so the tokens do not change."""
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def chunk_key(version, text):
+    return hashlib.sha256(json.dumps([version, normalize_chunk(text)]).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Embeddings by content hash in Postgres, on a connection of its own.
+
+    The encode workers share one cache, so every call is serialized; writes are
+    autocommitted and independent of the document transactions.
+    """
+
+    def __init__(self, conn, version):
+        self.conn = conn
+        self.conn.autocommit = True
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Fail now, not mid-ingest, when the table is missing
+        self.conn.cursor().execute("SELECT key, model, embedding FROM embedding_cache LIMIT 0;")
+
+    def key(self, text):
+        return chunk_key(self.version, text)
+
+    def get_many(self, keys):
+        """Cached embeddings for the keys that have one, as {key: float32 vector}."""
+        found = {}
+        keys = list(set(keys))
+        with self._lock:
+            cur = self.conn.cursor()
+            for start in range(0, len(keys), LOOKUP_BATCH):
+                cur.execute("SELECT key, embedding FROM embedding_cache WHERE key = ANY(%s);",
+                            (keys[start:start + LOOKUP_BATCH],))
+                found.update((key, np.frombuffer(embedding, dtype="<f4")) for key, embedding in cur.fetchall())
+        return found
+
+    def put_many(self, embeddings):
+        """Store {key: vector} entries; keys already present are left as they are."""
+        if not embeddings:
+            return
+        rows = [(key, self.version, Binary(np.asarray(vector, dtype="<f4").tobytes()))
+                for key, vector in embeddings.items()]
+        with self._lock:
+            execute_values(self.conn.cursor(), """
+                INSERT INTO embedding_cache (key, model, embedding) VALUES %s
+                ON CONFLICT (key) DO NOTHING;
+            """, rows)
+
+    def record(self, hits, misses):
+        """Count chunks served from the cache and chunks that had to be embedded."""
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+        METRICS.inc("embedding_cache_hits_total", hits)
+        METRICS.inc("embedding_cache_misses_total", misses)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def prune(self):
+        """Delete the entries of every other model version; returns how many were removed."""
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute("DELETE FROM embedding_cache WHERE model <> %s;", (self.version,))
+            return cur.rowcount
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,318 @@
+"""Staged ingest pipeline: read -> chunk -> encode -> write.
+
+Each stage runs concurrently and hands work to the next through a bounded queue,
+so a slow stage applies backpressure instead of letting the others buffer the
+whole corpus:
+
+    reader threads -> text queue -> chunk processes -> chunk queue
+        -> encode workers -> write queue -> writer (calling thread)
+
+Files are read and decoded by a thread pool, chunked and tokenized in a process
+pool, embedded in length-sorted batches by one or more encode threads, and
+written by the caller's DocumentWriter, which owns the database connection.
+
+Given an EmbeddingCache, the encode stage only runs the model on chunk texts it
+has not embedded before.
+
+Files at or above stream_threshold bytes skip the concurrent stages: they are
+read incrementally, chunked lazily and embedded and COPYed in bounded batches
+inside one transaction, so peak memory does not grow with file size.
+"""
+
+import io
+import os
+import copy
+import time
+import logging
+import queue
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+from chunking import chunk_file, iter_chunks, kind_for, make_token_counter
+from metrics import METRICS, span
+
+# Chunk workers only tokenize; keep the Rust tokenizer from spawning its own threads per process
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of a stage's output
+_DONE = object()
+
+ChangedFile = namedtuple("ChangedFile", ["filepath", "filename", "content_hash", "mtime", "size"])
+PendingFile = namedtuple("PendingFile", ["filename", "chunks", "token_lengths", "content_hash", "mtime", "size"])
+
+# Per-process token counter and chunk budget, set by _init_chunk_worker
+_count_tokens = None
+_max_tokens = None
+
+
+def _init_chunk_worker(tokenizer, max_length):
+    """Process pool initializer: build the token counter once per process."""
+    global _count_tokens, _max_tokens
+    _count_tokens = make_token_counter(tokenizer)
+    _max_tokens = max_length - 2  # leave room for [CLS] and [SEP]
+
+
+def chunk_and_measure(text, kind):
+    """Chunk a document along its structure and return (chunks, token_lengths, seconds spent)."""
+    start = time.perf_counter()
+    pairs = list(iter_chunks(io.StringIO(text), kind, _count_tokens, _max_tokens))
+    return [chunk for chunk, _ in pairs], [tokens for _, tokens in pairs], time.perf_counter() - start
+
+
+def encode_chunks(model, texts, lengths, batch_size=32, cache=None):
+    """Embed texts in fixed-size batches of similar token length, returned in input order.
+
+    With an EmbeddingCache, cached texts are not run through the model, and a text
+    repeated in the batch is embedded once.
+    """
+    embeddings = np.empty((len(texts), model.get_sentence_embedding_dimension()), dtype=np.float32)
+    if not texts:
+        return embeddings
+    todo = np.arange(len(texts))
+    if cache is not None:
+        keys = [cache.key(text) for text in texts]
+        with span("embedding_cache"):
+            found = cache.get_many(keys)
+        missing = {}  # key -> positions of the texts it stands for
+        for i, key in enumerate(keys):
+            if key in found:
+                embeddings[i] = found[key]
+            else:
+                missing.setdefault(key, []).append(i)
+        todo = np.array([positions[0] for positions in missing.values()], dtype=np.int64)
+        cache.record(len(texts) - len(todo), len(todo))
+    # Sorting by token length keeps padding inside each batch to a minimum
+    order = todo[np.argsort(np.asarray(lengths)[todo], kind="stable")]
+    if len(order):
+        with span("encode"):
+            for start in range(0, len(order), batch_size):
+                batch = order[start:start + batch_size]
+                embeddings[batch] = model.encode([texts[i] for i in batch], batch_size=batch_size,
+                                                 convert_to_numpy=True)
+    if cache is not None and missing:
+        for positions in missing.values():
+            embeddings[positions[1:]] = embeddings[positions[0]]
+        with span("embedding_cache"):
+            cache.put_many({keys[i]: embeddings[i] for i in todo})
+    return embeddings
+
+
+class IngestPipeline:
+    """Run changed files through the read/chunk/encode/write stages concurrently."""
+
+    def __init__(self, model, writer, batch_size=32, queue_chunks=1024,
+                 read_workers=4, chunk_workers=2, encode_workers=1, queue_depth=8,
+                 stream_threshold=8 * 1024 * 1024, cache=None):
+        self.model = model
+        self.writer = writer
+        self.batch_size = batch_size
+        self.queue_chunks = queue_chunks
+        self.read_workers = max(1, read_workers)
+        self.chunk_workers = chunk_workers
+        self.encode_workers = max(1, encode_workers)
+        self.queue_depth = max(1, queue_depth)
+        self.stream_threshold = stream_threshold
+        self.cache = cache
+
+    def run(self, changed_files):
+        """Process every changed file and return (processed_files, total_chunks)."""
+        large_files = [item for item in changed_files if item.size >= self.stream_threshold]
+        small_files = [item for item in changed_files if item.size < self.stream_threshold]
+        processed_files, total_chunks = self._run_stages(small_files) if small_files else (0, 0)
+
+        # The stage threads are done with the writer; stream the large files one at a time
+        for item in large_files:
+            try:
+                logger.info(f"Streaming large file: {item.filename} ({item.size / 1024 / 1024:.1f} MB)")
+                total_chunks += self._stream_file(item)
+                processed_files += 1
+            except Exception as e:
+                logger.error(f"Error streaming {item.filename}: {e}")
+        return processed_files, total_chunks
+
+    def _counter_tokenizer(self):
+        """A private copy of the model's tokenizer for counting chunk tokens in this process.
+
+        The counter turns truncation off and model.encode() turns it back on; doing
+        that on the shared fast tokenizer while an encode thread is using it raises
+        "Already borrowed". (Chunk processes get their own copy by pickling.)
+        """
+        return copy.deepcopy(self.model.tokenizer)
+
+    def _stream_file(self, item):
+        """Chunk, embed and write one file in bounded batches; returns its chunk count."""
+        count_tokens = make_token_counter(self._counter_tokenizer())
+        chunks = chunk_file(item.filepath, count_tokens, self.model.max_seq_length - 2)
+
+        def batches():
+            while True:
+                # Reading happens lazily inside chunking here, so both count as the chunk stage
+                with span("chunk", streamed=True):
+                    batch = list(islice(chunks, self.queue_chunks))
+                if not batch:
+                    return
+                texts = [chunk for chunk, _ in batch]
+                yield texts, encode_chunks(self.model, texts, [tokens for _, tokens in batch], self.batch_size,
+                                           self.cache)
+
+        return self.writer.replace_file_streaming(item.filename, batches(), item.content_hash, item.mtime, item.size)
+
+    def _run_stages(self, changed_files):
+        """Run the concurrent read/chunk/encode/write stages over in-memory-sized files."""
+        paths = queue.Queue()
+        for item in changed_files:
+            paths.put(item)
+        text_queue = queue.Queue(self.queue_depth)
+        chunk_queue = queue.Queue(self.queue_depth)
+        write_queue = queue.Queue(self.queue_depth)
+
+        # Start the chunk processes before any pipeline thread exists
+        pool = None
+        if self.chunk_workers > 0:
+            pool = ProcessPoolExecutor(
+                self.chunk_workers,
+                initializer=_init_chunk_worker,
+                initargs=(self.model.tokenizer, self.model.max_seq_length)
+            )
+            list(pool.map(int, range(self.chunk_workers)))
+        else:
+            _init_chunk_worker(self._counter_tokenizer(), self.model.max_seq_length)
+
+        threads = [threading.Thread(target=self._read_stage, args=(paths, text_queue), daemon=True),
+                   threading.Thread(target=self._chunk_stage, args=(pool, text_queue, chunk_queue), daemon=True)]
+        threads += [threading.Thread(target=self._encode_stage, args=(chunk_queue, write_queue), daemon=True)
+                    for _ in range(self.encode_workers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            return self._write_stage(write_queue)
+        finally:
+            for thread in threads:
+                thread.join()
+            if pool is not None:
+                pool.shutdown()
+
+    def _read_stage(self, paths, text_queue):
+        """Read and decode files on a thread pool."""
+        def read_loop():
+            while True:
+                try:
+                    item = paths.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    with span("file_read"):
+                        with open(item.filepath, "r", encoding="utf-8") as f:
+                            text = f.read()
+                    text_queue.put((item, text))
+                except Exception as e:
+                    logger.error(f"Error reading {item.filename}: {e}")
+
+        try:
+            with ThreadPoolExecutor(self.read_workers) as readers:
+                for _ in range(self.read_workers):
+                    readers.submit(read_loop)
+        finally:
+            text_queue.put(_DONE)
+
+    def _chunk_stage(self, pool, text_queue, chunk_queue):
+        """Chunk and tokenize documents, keeping at most queue_depth in flight."""
+        in_flight = deque()
+
+        def emit(item, future):
+            try:
+                chunks, lengths, seconds = future.result() if pool is not None else future
+            except Exception as e:
+                logger.error(f"Error chunking {item.filename}: {e}")
+                return
+            # Chunking runs in worker processes; their timings are recorded here
+            METRICS.record("chunk", seconds)
+            if not chunks:
+                logger.warning(f"Empty file, no chunks stored: {item.filename}")
+            else:
+                logger.info(f"Created {len(chunks)} chunks from {item.filename}")
+            chunk_queue.put(PendingFile(item.filename, chunks, lengths, item.content_hash, item.mtime, item.size))
+
+        try:
+            while True:
+                entry = text_queue.get()
+                if entry is _DONE:
+                    break
+                item, text = entry
+                kind = kind_for(item.filepath)
+                if pool is None:
+                    try:
+                        emit(item, chunk_and_measure(text, kind))
+                    except Exception as e:
+                        logger.error(f"Error chunking {item.filename}: {e}")
+                    continue
+                in_flight.append((item, pool.submit(chunk_and_measure, text, kind)))
+                if len(in_flight) >= self.queue_depth:
+                    emit(*in_flight.popleft())
+            while in_flight:
+                emit(*in_flight.popleft())
+        finally:
+            for _ in range(self.encode_workers):
+                chunk_queue.put(_DONE)
+
+    def _encode_stage(self, chunk_queue, write_queue):
+        """Collect chunks across files and embed them in length-sorted batches."""
+        pending = []
+        chunk_count = 0
+
+        def flush():
+            texts = [chunk for item in pending for chunk in item.chunks]
+            lengths = [length for item in pending for length in item.token_lengths]
+            try:
+                logger.info(f"Encoding {len(texts)} chunks from {len(pending)} files")
+                write_queue.put((list(pending), encode_chunks(self.model, texts, lengths, self.batch_size,
+                                                              self.cache)))
+            except Exception as e:
+                logger.error(f"Error encoding {', '.join(item.filename for item in pending)}: {e}")
+
+        try:
+            while True:
+                item = chunk_queue.get()
+                if item is _DONE:
+                    break
+                pending.append(item)
+                chunk_count += len(item.chunks)
+                if chunk_count >= self.queue_chunks:
+                    flush()
+                    pending, chunk_count = [], 0
+            if pending:
+                flush()
+        finally:
+            write_queue.put(_DONE)
+
+    def _write_stage(self, write_queue):
+        """Hand each encoded file to the writer; rows map back to files by offset.
+
+        Returns the files and chunks the writer actually committed.
+        """
+        files_before, chunks_before = self.writer.files_written, self.writer.chunks_written
+        finished_encoders = 0
+        while finished_encoders < self.encode_workers:
+            entry = write_queue.get()
+            if entry is _DONE:
+                finished_encoders += 1
+                continue
+            pending, embeddings = entry
+            offset = 0
+            for item in pending:
+                count = len(item.chunks)
+                try:
+                    self.writer.replace_file(item.filename, item.chunks, embeddings[offset:offset + count],
+                                             item.content_hash, item.mtime, item.size)
+                except Exception as e:
+                    logger.error(f"Error writing {item.filename}: {e}")
+                offset += count
+        self.writer.flush()
+        return self.writer.files_written - files_before, self.writer.chunks_written - chunks_before
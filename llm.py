@@ -0,0 +1,381 @@
+"""
+Ollama clients for rag.py and rag_server.py.
+
+Every request carries keep_alive so Ollama keeps the model resident between
+queries instead of unloading it after its default five minutes. The static
+instruction is sent as the system prompt, which Ollama renders ahead of the
+per-query context and question, so consecutive prompts share a prefix whose KV
+cache can be reused. ChatSession keeps a conversation on /api/chat so a
+follow-up question can refer to earlier ones; the history holds the questions
+and answers only, never the retrieved context sent with them.
+
+OllamaClient reuses pooled keep-alive connections (one requests.Session) and
+AsyncOllamaClient does the same on httpx.AsyncClient for asyncio callers. Both
+bound the number of generations in flight, split the timeout into connect and
+first-token parts, retry failed requests with exponential backoff, and spread
+requests over one or more Ollama instances (OLLAMA_URL may be a comma-separated
+list).
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+from itertools import count
+
+from context import context_window, estimate_tokens
+
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
+
+# How long Ollama keeps the model loaded after a request (Ollama duration, e.g. "30m", or -1 for ever)
+DEFAULT_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+# Generations allowed in flight per client, across all Ollama instances
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+
+CONNECT_TIMEOUT = 10
+# Longest wait for the first token (and, when streaming, between tokens)
+FIRST_TOKEN_TIMEOUT = 120
+
+# Statuses worth retrying: overloaded or restarting instances
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def _keep_alive_value(keep_alive):
+    """Ollama accepts durations as strings and seconds (or -1) as numbers."""
+    try:
+        return int(keep_alive)
+    except (TypeError, ValueError):
+        return keep_alive
+
+
+def _split_urls(base_urls):
+    if isinstance(base_urls, str):
+        base_urls = base_urls.split(",")
+    return [url.strip().rstrip("/") for url in base_urls if url.strip()]
+
+
+def _generate_token(chunk):
+    return chunk.get("response", "")
+
+
+def _chat_token(chunk):
+    return chunk.get("message", {}).get("content", "")
+
+
+class RetryableStatus(Exception):
+    """Ollama answered with a status that another attempt may not get."""
+
+
+class _Collector:
+    """Accumulate a (streamed) Ollama response and its timing stats.
+
+    stats holds ttft (seconds to the first token, streaming only), eval_count,
+    tokens_per_sec (decode throughput as reported by Ollama), prompt_eval_count,
+    prompt_eval_time and total.
+    """
+
+    def __init__(self, token_of, on_token=None):
+        self.token_of = token_of
+        self.on_token = on_token
+        self.start = time.perf_counter()
+        self.pieces = []
+        self.stats = {"ttft": None, "eval_count": 0, "tokens_per_sec": None,
+                      "prompt_eval_count": None, "prompt_eval_time": None, "total": None}
+
+    @property
+    def started(self):
+        """Whether any token has been handed to on_token (the request can no longer be retried)."""
+        return bool(self.pieces)
+
+    def feed_line(self, line):
+        """Consume one NDJSON line; returns True on the final chunk."""
+        if not line:
+            return False
+        chunk = json.loads(line)
+        if chunk.get("error"):
+            raise RuntimeError(chunk["error"])
+        token = self.token_of(chunk)
+        if token:
+            if self.stats["ttft"] is None:
+                self.stats["ttft"] = time.perf_counter() - self.start
+            self.pieces.append(token)
+            if self.on_token:
+                self.on_token(token)
+        if chunk.get("done"):
+            self.finish(chunk)
+            return True
+        return False
+
+    def feed_body(self, body):
+        """Consume a non-streamed response body."""
+        self.pieces.append(self.token_of(body))
+        self.finish(body)
+
+    def finish(self, chunk=None):
+        chunk = chunk or {}
+        stats = self.stats
+        stats["eval_count"] = chunk.get("eval_count", len(self.pieces))
+        stats["prompt_eval_count"] = chunk.get("prompt_eval_count")
+        eval_duration = chunk.get("eval_duration")
+        if eval_duration:
+            stats["tokens_per_sec"] = stats["eval_count"] / (eval_duration / 1e9)
+        prompt_eval_duration = chunk.get("prompt_eval_duration")
+        if prompt_eval_duration:
+            stats["prompt_eval_time"] = prompt_eval_duration / 1e9
+        stats["total"] = time.perf_counter() - self.start
+        if stats["tokens_per_sec"] is None and stats["ttft"] is not None and stats["total"] > stats["ttft"]:
+            stats["tokens_per_sec"] = len(self.pieces) / (stats["total"] - stats["ttft"])
+
+    def result(self):
+        if self.stats["total"] is None:
+            self.finish()
+        return "".join(self.pieces), self.stats
+
+
+class _BaseClient:
+    """Settings and request building shared by the sync and async clients."""
+
+    def __init__(self, base_urls=OLLAMA_URL, keep_alive=DEFAULT_KEEP_ALIVE, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 connect_timeout=CONNECT_TIMEOUT, first_token_timeout=FIRST_TOKEN_TIMEOUT, retries=2, backoff=0.5):
+        self.base_urls = _split_urls(base_urls)
+        if not self.base_urls:
+            raise ValueError("at least one Ollama URL is required")
+        self.keep_alive = _keep_alive_value(keep_alive)
+        self.max_concurrency = max(1, max_concurrency)
+        self.connect_timeout = connect_timeout
+        self.first_token_timeout = first_token_timeout
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self._next_url = count()
+
+    @property
+    def base_url(self):
+        return self.base_urls[0]
+
+    def _url_for(self, attempt_offset, path):
+        """Round-robin across instances; each retry moves on to the next one."""
+        return f"{self.base_urls[attempt_offset % len(self.base_urls)]}{path}"
+
+    def _backoff_delay(self, attempt):
+        return self.backoff * (2 ** attempt) * (0.5 + random.random() / 2)
+
+    @staticmethod
+    def _options(model_name, context_tokens=None):
+        # Ollama would otherwise run at 2048 tokens and cut the packed context short
+        return {"num_ctx": context_window(model_name, context_tokens)}
+
+    def _payload(self, payload, stream, context_tokens=None):
+        return {**payload, "stream": stream, "keep_alive": self.keep_alive,
+                "options": self._options(payload["model"], context_tokens)}
+
+    @staticmethod
+    def _generate_payload(prompt, model_name, system):
+        payload = {"model": model_name, "prompt": prompt}
+        if system:
+            payload["system"] = system
+        return payload
+
+
+class OllamaClient(_BaseClient):
+    """Thread-safe /api/generate and /api/chat client over a pooled requests.Session."""
+
+    def __init__(self, base_urls=OLLAMA_URL, keep_alive=DEFAULT_KEEP_ALIVE, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 connect_timeout=CONNECT_TIMEOUT, first_token_timeout=FIRST_TOKEN_TIMEOUT, retries=2, backoff=0.5):
+        # Imported here so importing this module (for its settings) stays cheap
+        import requests
+        from requests.adapters import HTTPAdapter
+        super().__init__(base_urls, keep_alive, max_concurrency, connect_timeout, first_token_timeout,
+                         retries, backoff)
+        self._requests = requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.base_urls), pool_maxsize=self.max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+
+    def generate(self, prompt, model_name="gemma:2b", system=None, stream=False, on_token=None,
+                 context_tokens=None):
+        """Complete a prompt; returns (answer, stats). context_tokens sizes num_ctx as in context.py."""
+        return self._request("/api/generate", self._generate_payload(prompt, model_name, system),
+                             stream, on_token, _generate_token, context_tokens)
+
+    def chat(self, messages, model_name="gemma:2b", stream=False, on_token=None, context_tokens=None):
+        """Answer the last message of a conversation; returns (answer, stats)."""
+        return self._request("/api/chat", {"model": model_name, "messages": messages}, stream, on_token,
+                             _chat_token, context_tokens)
+
+    def preload(self, model_name="gemma:2b"):
+        """Load the model on every instance and pin it for keep_alive; a prompt-less generate does only that."""
+        for base_url in self.base_urls:
+            response = self.session.post(
+                f"{base_url}/api/generate",
+                json={"model": model_name, "keep_alive": self.keep_alive, "options": self._options(model_name)},
+                timeout=(self.connect_timeout, self.first_token_timeout)
+            )
+            response.raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+    def _request(self, path, payload, stream, on_token, token_of, context_tokens=None):
+        """POST to Ollama with retries and collect the answer, calling on_token per streamed piece."""
+        payload = self._payload(payload, stream, context_tokens)
+        first = next(self._next_url)
+        with self._slots:
+            for attempt in range(self.retries + 1):
+                collector = _Collector(token_of, on_token)
+                try:
+                    self._attempt(self._url_for(first + attempt, path), payload, stream, collector)
+                    return collector.result()
+                except (self._requests.exceptions.ConnectionError, self._requests.exceptions.Timeout,
+                        RetryableStatus) as e:
+                    # Tokens already shown to the caller cannot be taken back
+                    if collector.started or attempt == self.retries:
+                        if isinstance(e, RetryableStatus):
+                            raise self._requests.exceptions.HTTPError(str(e)) from e
+                        raise
+                    delay = self._backoff_delay(attempt)
+                    logger.warning(f"LLM request failed ({e}), retrying in {delay:.1f}s")
+                    time.sleep(delay)
+
+    def _attempt(self, url, payload, stream, collector):
+        timeout = (self.connect_timeout, self.first_token_timeout)
+        with self.session.post(url, json=payload, stream=stream, timeout=timeout) as response:
+            if response.status_code in RETRY_STATUSES:
+                raise RetryableStatus(f"LLM service returned status {response.status_code}")
+            if response.status_code != 200:
+                raise self._requests.exceptions.HTTPError(f"LLM service returned status {response.status_code}")
+            if not stream:
+                collector.feed_body(response.json())
+                return
+            # Ollama sends one JSON object per line; chunk_size=None yields each chunk as it arrives
+            for line in response.iter_lines(chunk_size=None):
+                if collector.feed_line(line):
+                    break
+
+
+class AsyncOllamaClient(_BaseClient):
+    """asyncio counterpart of OllamaClient on httpx.AsyncClient (pip install httpx).
+
+    Use as an async context manager, or call aclose() when done:
+
+        async with AsyncOllamaClient() as client:
+            answers = await asyncio.gather(*(client.generate(p) for p in prompts))
+    """
+
+    def __init__(self, base_urls=OLLAMA_URL, keep_alive=DEFAULT_KEEP_ALIVE, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 connect_timeout=CONNECT_TIMEOUT, first_token_timeout=FIRST_TOKEN_TIMEOUT, retries=2, backoff=0.5):
+        import asyncio
+        try:
+            import httpx
+        except ImportError as e:
+            raise ImportError("AsyncOllamaClient needs httpx: pip install httpx") from e
+        super().__init__(base_urls, keep_alive, max_concurrency, connect_timeout, first_token_timeout,
+                         retries, backoff)
+        self._httpx = httpx
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(first_token_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+        )
+        self._asyncio = asyncio
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def generate(self, prompt, model_name="gemma:2b", system=None, stream=False, on_token=None,
+                       context_tokens=None):
+        """Complete a prompt; returns (answer, stats)."""
+        return await self._request("/api/generate", self._generate_payload(prompt, model_name, system),
+                                   stream, on_token, _generate_token, context_tokens)
+
+    async def chat(self, messages, model_name="gemma:2b", stream=False, on_token=None, context_tokens=None):
+        """Answer the last message of a conversation; returns (answer, stats)."""
+        return await self._request("/api/chat", {"model": model_name, "messages": messages},
+                                   stream, on_token, _chat_token, context_tokens)
+
+    async def _request(self, path, payload, stream, on_token, token_of, context_tokens=None):
+        httpx = self._httpx
+        payload = self._payload(payload, stream, context_tokens)
+        first = next(self._next_url)
+        async with self._slots:
+            for attempt in range(self.retries + 1):
+                collector = _Collector(token_of, on_token)
+                try:
+                    await self._attempt(self._url_for(first + attempt, path), payload, stream, collector)
+                    return collector.result()
+                except (httpx.TransportError, RetryableStatus) as e:
+                    if collector.started or attempt == self.retries:
+                        raise
+                    delay = self._backoff_delay(attempt)
+                    logger.warning(f"LLM request failed ({e}), retrying in {delay:.1f}s")
+                    await self._asyncio.sleep(delay)
+
+    async def _attempt(self, url, payload, stream, collector):
+        async with self.client.stream("POST", url, json=payload) as response:
+            if response.status_code in RETRY_STATUSES:
+                raise RetryableStatus(f"LLM service returned status {response.status_code}")
+            if response.status_code != 200:
+                raise RuntimeError(f"LLM service returned status {response.status_code}")
+            if not stream:
+                collector.feed_body(json.loads(await response.aread()))
+                return
+            async for line in response.aiter_lines():
+                if collector.feed_line(line):
+                    break
+
+
+class ChatSession:
+    """A conversation with one model over /api/chat.
+
+    Each turn sends the history and the new message. The message may carry
+    retrieved context for this turn only: the history keeps the plain question
+    instead, so earlier contexts are never resent and the conversation stays
+    within the model's window. Only the last max_turns exchanges are kept.
+    """
+
+    def __init__(self, client, model_name="gemma:2b", system=None, max_turns=4, context_tokens=None):
+        self.client = client
+        self.model_name = model_name
+        self.system = system
+        self.max_turns = max_turns
+        self.context_tokens = context_tokens
+        self.turns = []
+
+    @property
+    def messages(self):
+        head = [{"role": "system", "content": self.system}] if self.system else []
+        return head + [message for turn in self.turns for message in turn]
+
+    def history_tokens(self):
+        """Estimated tokens the history adds to the next turn."""
+        return sum(estimate_tokens(message["content"]) for turn in self.turns for message in turn)
+
+    def ask(self, content, stream=False, on_token=None, question=None):
+        """Send a user message and return (answer, stats).
+
+        The exchange joins the history with question (the message without its
+        context) in place of content, when given.
+        """
+        message = {"role": "user", "content": content}
+        answer, stats = self.client.chat(self.messages + [message], self.model_name, stream, on_token,
+                                         self.context_tokens)
+        asked = {"role": "user", "content": question} if question is not None else message
+        self.turns.append((asked, {"role": "assistant", "content": answer}))
+        del self.turns[:-self.max_turns]
+        return answer, stats
+
+    def reset(self):
+        self.turns = []
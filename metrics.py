@@ -0,0 +1,212 @@
+"""
+Per-stage latency metrics and tracing for the query path and the encoder.
+
+Code under measurement is wrapped in a span:
+
+    with span("vector_search", mode=mode):
+        results = store.search(...)
+
+Every span is observed in the rag_stage_seconds histogram (labelled by stage)
+and kept as a trace event; counters (queries, cache hits, chunks embedded, ...)
+are bumped with METRICS.inc(). The collected metrics can be written in the
+Prometheus text exposition format or as JSON (METRICS.write()), and rag_server.py
+serves them on GET /metrics.
+
+profile() runs a block under cProfile and writes the stats (pstats format, for
+snakeviz, gprof2dot or flameprof) next to the spans as Chrome trace events (for
+chrome://tracing or ui.perfetto.dev).
+"""
+
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+NAMESPACE = "rag"
+
+# Histogram bucket upper bounds in seconds: sub-millisecond searches up to multi-minute generations
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Trace events kept for profile(); older ones are dropped so long-running processes stay bounded
+MAX_TRACE_EVENTS = 100_000
+
+
+class Histogram:
+    """Cumulative-bucket histogram, as Prometheus exposes them."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        """(upper bound, observations <= bound) pairs, ending with +Inf."""
+        total, out = 0, []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            out.append((bound, total))
+        return out
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Metrics:
+    """Thread-safe counters, histograms and trace events for one process."""
+
+    def __init__(self, namespace=NAMESPACE, buckets=DEFAULT_BUCKETS):
+        self.namespace = namespace
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}    # name -> {label key: value}
+            self.histograms = {}  # name -> {label key: Histogram}
+            self.events = []
+            self._origin = time.perf_counter()
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter."""
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            key = _label_key(labels)
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record one observation in a histogram."""
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            key = _label_key(labels)
+            if key not in series:
+                series[key] = Histogram(self.buckets)
+            series[key].observe(value)
+
+    def record(self, stage, seconds, start=None, **labels):
+        """Record a stage duration measured elsewhere (e.g. reported by Ollama or a worker process)."""
+        self.observe("stage_seconds", seconds, stage=stage, **labels)
+        if start is None:
+            start = time.perf_counter() - seconds
+        with self._lock:
+            if len(self.events) >= MAX_TRACE_EVENTS:
+                del self.events[:len(self.events) // 2]
+            self.events.append({
+                "name": stage, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                "ts": (start - self._origin) * 1e6, "dur": seconds * 1e6,
+                "args": {key: value for key, value in labels.items() if value is not None},
+            })
+        logger.debug(f"{stage} took {seconds * 1000:.1f}ms")
+
+    @contextmanager
+    def span(self, stage, **labels):
+        """Time the enclosed block as one stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, start, **labels)
+
+    def to_prometheus(self):
+        """Render every series in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                full = f"{self.namespace}_{name}"
+                lines.append(f"# TYPE {full} counter")
+                lines.extend(f"{full}{_format_labels(key)} {value:g}" for key, value in sorted(series.items()))
+            for name, series in sorted(self.histograms.items()):
+                full = f"{self.namespace}_{name}"
+                lines.append(f"# TYPE {full} histogram")
+                for key, histogram in sorted(series.items()):
+                    for bound, count in histogram.cumulative():
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        lines.append(f"{full}_bucket{_format_labels(key, [('le', le)])} {count}")
+                    lines.append(f"{full}_sum{_format_labels(key)} {histogram.sum:.6f}")
+                    lines.append(f"{full}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self):
+        """Every series as a JSON-serializable dict."""
+        with self._lock:
+            return {
+                "counters": [
+                    {"name": f"{self.namespace}_{name}", "labels": dict(key), "value": value}
+                    for name, series in sorted(self.counters.items()) for key, value in sorted(series.items())
+                ],
+                "histograms": [
+                    {"name": f"{self.namespace}_{name}", "labels": dict(key), "count": h.count, "sum": h.sum,
+                     "mean": h.sum / h.count if h.count else 0.0, "max": h.max,
+                     "buckets": {("+Inf" if bound == float("inf") else f"{bound:g}"): count
+                                 for bound, count in h.cumulative()}}
+                    for name, series in sorted(self.histograms.items()) for key, h in sorted(series.items())
+                ],
+            }
+
+    def write(self, path):
+        """Write the metrics to path: JSON for a .json file, Prometheus text otherwise."""
+        text = json.dumps(self.to_json(), indent=2) if str(path).endswith(".json") else self.to_prometheus()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    def write_trace(self, path):
+        """Write the recorded spans as Chrome trace events."""
+        with self._lock:
+            events = list(self.events)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self):
+        """One line per stage: count, mean and max milliseconds."""
+        with self._lock:
+            stages = sorted(self.histograms.get("stage_seconds", {}).items())
+        rows = []
+        for key, histogram in stages:
+            labels = dict(key)
+            name = labels.pop("stage")
+            if labels:
+                name += " (" + ", ".join(f"{label}={value}" for label, value in labels.items()) + ")"
+            rows.append(f"{name}: {histogram.count}x, mean {histogram.sum / histogram.count * 1000:.1f}ms, "
+                        f"max {histogram.max * 1000:.1f}ms")
+        return rows
+
+
+METRICS = Metrics()
+span = METRICS.span
+
+
+@contextmanager
+def profile(path):
+    """cProfile the enclosed block; writes path (pstats) and path.trace.json (spans)."""
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        METRICS.write_trace(f"{path}.trace.json")
+        logger.info(f"Profile written to {path} (view with snakeviz or flameprof) and spans to {path}.trace.json")
@@ -4,14 +4,72 @@ CREATE EXTENSION IF NOT EXISTS vector;
 -- Create the documents table for storing embeddings
 CREATE TABLE IF NOT EXISTS documents (
     id SERIAL PRIMARY KEY,
+    -- Path relative to the data directory, e.g. projects/alpha/README.md
     filename TEXT NOT NULL,
     chunk_index INTEGER NOT NULL,
     content TEXT NOT NULL,
     embedding VECTOR(384) NOT NULL,
+    -- Lexical index for hybrid search; 'simple' keeps identifiers and error codes unstemmed
+    content_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', content)) STORED,
+    -- File metadata copied onto every chunk so rag.py --path/--type/--tag/--since filter inside the search
+    file_type TEXT NOT NULL DEFAULT '',
+    tags TEXT[] NOT NULL DEFAULT '{}',
+    mtime TIMESTAMPTZ,
     created_at TIMESTAMP DEFAULT NOW()
 );
 
--- Create an index for faster vector similarity search
-CREATE INDEX IF NOT EXISTS documents_embedding_idx 
-ON documents USING ivfflat (embedding vector_cosine_ops)
-WITH (lists = 100); 
\ No newline at end of file
+-- Per-file lookups used when the encoder swaps a single file's chunks; text_pattern_ops also
+-- serves the folder-prefix ranges of rag.py --path
+CREATE INDEX IF NOT EXISTS documents_filename_idx ON documents (filename text_pattern_ops);
+
+-- Metadata filters; selective ones can be answered from these before the vector index
+CREATE INDEX IF NOT EXISTS documents_file_type_idx ON documents (file_type);
+CREATE INDEX IF NOT EXISTS documents_mtime_idx ON documents (mtime);
+CREATE INDEX IF NOT EXISTS documents_tags_idx ON documents USING GIN (tags);
+
+-- Full-text lookups for rag.py --mode hybrid
+CREATE INDEX IF NOT EXISTS documents_content_tsv_idx ON documents USING GIN (content_tsv);
+
+-- Manifest of indexed files, used by the encoder to skip unchanged files
+CREATE TABLE IF NOT EXISTS document_files (
+    filename TEXT PRIMARY KEY,
+    content_hash TEXT NOT NULL,
+    mtime TIMESTAMPTZ NOT NULL,
+    size_bytes BIGINT NOT NULL,
+    chunk_count INTEGER NOT NULL,
+    indexed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- The vector index (documents_embedding_idx, vector_cosine_ops to match the <=> operator
+-- used by rag.py) is built by the encoder after ingest: IVFFlat centroids trained on an
+-- empty table are meaningless, and HNSW builds much faster over a filled table.
+
+-- Corpus version, bumped on every change to documents so query-side caches can be invalidated
+CREATE TABLE IF NOT EXISTS corpus_state (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+INSERT INTO corpus_state (id) VALUES (TRUE) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_corpus_version() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE corpus_state SET version = version + 1, updated_at = NOW();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- OR REPLACE (PostgreSQL 14+) keeps the whole script safe to re-run on an existing database
+CREATE OR REPLACE TRIGGER documents_corpus_version
+AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON documents
+FOR EACH STATEMENT EXECUTE FUNCTION bump_corpus_version();
+
+-- Content-addressed embeddings reused by the encoder: key is a hash of (model version,
+-- normalized chunk text), so unchanged and repeated chunk text is never embedded twice
+CREATE TABLE IF NOT EXISTS embedding_cache (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    embedding BYTEA NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS embedding_cache_model_idx ON embedding_cache (model);
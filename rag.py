@@ -2,119 +2,390 @@
 """
 RAG Query Interface - Ask questions about your documents
 Usage: python rag.py "Your question here"
+       python rag.py --batch questions.jsonl --output results.jsonl
+       python rag.py --chat
 """
 
+import os
 import sys
 import argparse
-import psycopg2
-from sentence_transformers import SentenceTransformer
-import requests
 import json
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
+
+# Only light modules are imported up front so --help, server-backed and cached queries
+# start fast; psycopg2, requests and the embedding runtimes (torch, transformers,
+# onnxruntime) are imported on the code paths that use them. The startup stage of
+# benchmark.py checks that this stays true.
+from context import build_context, context_budget
+from embedders import BACKENDS, DEFAULT_BACKEND, DEFAULT_THREADS, EMBEDDING_MODEL, load_embedder, model_version
+from metrics import METRICS, profile, span
+from llm import DEFAULT_KEEP_ALIVE, DEFAULT_MAX_CONCURRENCY, OLLAMA_URL, ChatSession, OllamaClient
+from rag_cache import QueryCache
+from rerank import DEFAULT_BUDGET_MS, DEFAULT_CANDIDATES, RERANK_MODEL, Reranker
+from vectorstore import (DEFAULT_RERANK_FACTOR, QUANTIZATIONS, SEARCH_MODES, NumPyVectorStore, PgVectorStore,
+                         SearchFilter)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+DB_CONFIG = {
+    "dbname": "ragdb",
+    "user": "rag",
+    "password": "ragpass",
+    "host": "localhost",
+    "port": 5432,
+}
+
+# Sent unchanged ahead of every prompt, so Ollama can reuse its KV cache for it
+SYSTEM_PROMPT = """Use the following context to answer the question. Be specific and helpful.
+If you cannot answer based on the context, say so clearly."""
+
+PROMPT_TEMPLATE = """Context:
+{context}
+
+Question: {query}
+
+Answer:"""
+
+# Both parts of the prompt, for answer cache keys
+CACHE_TEMPLATE = SYSTEM_PROMPT + "\n\n" + PROMPT_TEMPLATE
+
+LLM_KEEP_ALIVE = DEFAULT_KEEP_ALIVE
+LLM_MAX_CONCURRENCY = DEFAULT_MAX_CONCURRENCY
+
+EMBEDDING_BACKEND = DEFAULT_BACKEND
+EMBEDDING_THREADS = DEFAULT_THREADS
+
 def parse_arguments():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(description='Ask questions about your documents using RAG')
-    parser.add_argument('query', help='Your question or query')
+    parser.add_argument('query', nargs='?', help='Your question or query')
     parser.add_argument('--model', default='gemma:2b', help='LLM model to use (default: gemma:2b)')
     parser.add_argument('--limit', type=int, default=5, help='Number of chunks to retrieve (default: 5)')
     parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose output')
-    return parser.parse_args()
+    parser.add_argument('--server', default=os.getenv("RAG_SERVER_URL"),
+                        help='URL of a running rag_server.py to answer through (default: $RAG_SERVER_URL)')
+    parser.add_argument('--store', default=os.getenv("RAG_VECTOR_STORE", "pgvector"),
+                        help='"pgvector", or a directory exported with embed.py --export-numpy (default: pgvector)')
+    parser.add_argument('--mode', choices=SEARCH_MODES, default=os.getenv("RAG_SEARCH_MODE", "vector"),
+                        help='Retrieval mode: vector similarity, or hybrid vector + full-text (default: vector)')
+    parser.add_argument('--context-tokens', type=int,
+                        help='Token budget for retrieved context (default: derived from --model)')
+    parser.add_argument('--path', help='Only search files in this folder (or this file), relative to the data directory')
+    parser.add_argument('--type', dest='file_types', action='append', metavar='TYPE',
+                        help='Only search files with this suffix, e.g. py or md; repeat or comma-separate for several')
+    parser.add_argument('--tag', dest='tags', action='append', metavar='TAG',
+                        help='Only search files with any of these tags (the folders on their path); repeatable')
+    parser.add_argument('--since', type=parse_since,
+                        help='Only search files modified since a date (2024-05-01) or a duration ago (7d, 12h, 2w)')
+    parser.add_argument('--ef-search', type=int, help='HNSW candidate list size (hnsw.ef_search, default: 40)')
+    parser.add_argument('--probes', type=int, help='IVFFlat lists to probe (ivfflat.probes, default: 1)')
+    parser.add_argument('--quantization', choices=QUANTIZATIONS, default=os.getenv("RAG_QUANTIZATION"),
+                        help='Search a compact copy of the embeddings, then re-rank exactly; must match '
+                             'embed.py --quantization for pgvector (default: none, or what the store was saved with)')
+    parser.add_argument('--rerank-factor', type=int, default=DEFAULT_RERANK_FACTOR,
+                        help=f'Quantized candidates re-ranked per result (default: {DEFAULT_RERANK_FACTOR})')
+    parser.add_argument('--no-stream', dest='stream', action='store_false',
+                        help='Wait for the complete answer instead of streaming tokens')
+    parser.add_argument('--no-cache', action='store_true', help='Bypass the query embedding and answer cache')
+    parser.add_argument('--clear-cache', action='store_true', help='Empty the query cache before running')
+    parser.add_argument('--cache-similarity', type=float,
+                        help='Also reuse answers to earlier questions at least this similar (e.g. 0.95)')
+    parser.add_argument('--explain', action='store_true',
+                        help='Print the search query plan and check it uses the vector index')
+    parser.add_argument('--rerank', action='store_true', default=os.getenv("RAG_RERANK") == "1",
+                        help=f'Re-rank a wider candidate set with a cross-encoder ({RERANK_MODEL}) and keep --limit')
+    parser.add_argument('--rerank-candidates', type=int, default=DEFAULT_CANDIDATES,
+                        help=f'Chunks retrieved for re-ranking (default: {DEFAULT_CANDIDATES})')
+    parser.add_argument('--rerank-budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help=f'Stop scoring candidates after about this long, 0 for no limit (default: {DEFAULT_BUDGET_MS:g})')
+    parser.add_argument('--embedding-backend', choices=BACKENDS, default=DEFAULT_BACKEND,
+                        help=f'Runtime for the query embedding model (default: {DEFAULT_BACKEND})')
+    parser.add_argument('--embedding-threads', type=int, default=DEFAULT_THREADS,
+                        help='CPU threads for the embedding model, 0 for the runtime default (default: 0)')
+    parser.add_argument('--keep-alive', default=DEFAULT_KEEP_ALIVE,
+                        help='How long Ollama keeps the model loaded, e.g. 30m or -1 (default: 30m)')
+    parser.add_argument('--chat', action='store_true',
+                        help='Ask follow-up questions interactively in one conversation')
+    parser.add_argument('--batch', metavar='QUESTIONS_JSONL',
+                        help='Answer every question in a JSONL file ({"id": ..., "query": ...} per line)')
+    parser.add_argument('--output', '-o', help='Where to write batch results as JSONL (default: stdout)')
+    parser.add_argument('--concurrency', type=int, default=2,
+                        help='Maximum LLM requests in flight in batch mode (default: 2)')
+    parser.add_argument('--metrics', metavar='FILE', default=os.getenv("RAG_METRICS_FILE"),
+                        help='Write per-stage latency metrics on exit: JSON for *.json, Prometheus text otherwise')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Run under cProfile and write the stats to FILE and the stage spans to FILE.trace.json')
+    args = parser.parse_args()
+    if not args.query and not args.batch and not args.chat:
+        parser.error("a query, --chat or --batch is required")
+    return args
+
+# Units accepted by --since durations, in seconds
+SINCE_UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+def parse_since(value):
+    """Parse --since: an ISO date or datetime (UTC unless it has an offset), or a duration like 7d ago."""
+    value = value.strip()
+    if value[:-1].isdigit() and value[-1:] in SINCE_UNITS:
+        return datetime.now(timezone.utc) - timedelta(seconds=int(value[:-1]) * SINCE_UNITS[value[-1]])
+    try:
+        since = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a date like 2024-05-01 or a duration like 7d, not {value!r}")
+    return since if since.tzinfo else since.replace(tzinfo=timezone.utc)
+
+def make_filters(path=None, file_types=None, tags=None, since=None):
+    """A SearchFilter from --path/--type/--tag/--since style values, or None when nothing is filtered."""
+    file_types = tuple(sorted({part.strip().lstrip(".").lower()
+                               for value in file_types or () for part in value.split(",") if part.strip()}))
+    tags = tuple(sorted({tag.strip() for tag in tags or () if tag.strip()}))
+    path = (path or "").strip("/") or None
+    if not (path or file_types or tags or since):
+        return None
+    return SearchFilter(path, file_types, tags, since)
+
+def search_filter(args):
+    """The SearchFilter the command line asks for, if any."""
+    return make_filters(args.path, args.file_types, args.tags, args.since)
 
 def connect_to_database():
     """Connect to the PostgreSQL database."""
+    import psycopg2
     try:
-        conn = psycopg2.connect(
-            dbname="ragdb",
-            user="rag",
-            password="ragpass",
-            host="localhost",
-            port=5432
-        )
+        with span("db_connect"):
+            conn = psycopg2.connect(**DB_CONFIG)
         return conn
     except psycopg2.Error as e:
         logger.error(f"Database connection failed: {e}")
         logger.info("Make sure the PostgreSQL service is running: docker compose ps")
         return None
 
-def retrieve_relevant_chunks(query, limit=5, verbose=False):
-    """Retrieve relevant document chunks using vector similarity."""
-    logger.info("Loading sentence transformer model...")
+def load_embedding_model():
+    """Load the model used to embed queries on the configured backend."""
+    # Loaded lazily so thin-client runs never pay for torch/onnxruntime
+    with span("model_load", backend=EMBEDDING_BACKEND):
+        return load_embedder(EMBEDDING_BACKEND, EMBEDDING_THREADS)
+
+def open_vector_store(spec="pgvector", quantization=None, rerank_factor=DEFAULT_RERANK_FACTOR):
+    """Open the configured store: pgvector, or a directory saved by NumPyVectorStore; None on failure."""
+    if spec == "pgvector":
+        if quantization == "int8":
+            logger.error("pgvector has no int8 type; use --quantization halfvec or binary")
+            return None
+        logger.info("Connecting to database...")
+        conn = connect_to_database()
+        return PgVectorStore(conn, quantization=quantization or "none", rerank_factor=rerank_factor) if conn else None
     try:
-        model = SentenceTransformer('all-MiniLM-L6-v2')
-    except Exception as e:
-        logger.error(f"Failed to load model: {e}")
+        return NumPyVectorStore.load(spec, mmap=True, quantization=quantization, rerank_factor=rerank_factor)
+    except (OSError, ValueError) as e:
+        logger.error(f"Cannot open vector store at {spec}: {e}")
+        return None
+
+def search_documents(store, query_vector, limit=5, verbose=False, ef_search=None, probes=None,
+                     mode="vector", query_text=None, filters=None):
+    """Return the best chunks as (content, filename, chunk_index, distance, id) rows.
+
+    mode="hybrid" fuses the vector ranking with a full-text ranking of query_text.
+    filters (a SearchFilter) limits the search to matching files.
+    """
+    with span("vector_search", mode=mode, filtered=bool(filters) or None):
+        results = store.search(query_vector, limit, mode, query_text, ef_search, probes, filters)
+    
+    # The vector ranking returns rows whenever any match, so no results means no (matching) documents
+    if not results:
+        if filters:
+            logger.warning(f"No documents match the filters: {describe_filters(filters)}")
+        else:
+            logger.warning("No documents found in database. Run the encoder service first.")
         return []
     
-    logger.info("Encoding query...")
-    query_vector = model.encode([query])[0].tolist()
+    if verbose:
+        logger.info(f"Retrieved {len(results)} relevant chunks:")
+        for i, (content, filename, chunk_idx, distance, _) in enumerate(results):
+            logger.info(f"  {i+1}. {filename}[{chunk_idx}] (distance: {distance:.3f})")
     
-    logger.info("Connecting to database...")
-    conn = connect_to_database()
-    if not conn:
+    return results
+
+def describe_filters(filters):
+    """The filters as rag.py options, for log messages."""
+    parts = [f"--path {filters.path}"] if filters.path else []
+    parts += [f"--type {','.join(filters.file_types)}"] if filters.file_types else []
+    parts += [f"--tag {tag}" for tag in filters.tags]
+    parts += [f"--since {filters.since.isoformat()}"] if filters.since else []
+    return " ".join(parts)
+
+def explain_search(store, query_vector, limit=5, ef_search=None, probes=None, mode="vector", query_text=None,
+                   filters=None):
+    """Print the search's EXPLAIN ANALYZE plan and return whether it used the vector index."""
+    if not isinstance(store, PgVectorStore):
+        print("--explain only applies to the pgvector store")
+        return False
+    plan = store.explain(query_vector, limit, mode, query_text, ef_search, probes, filters)
+    print(plan)
+    uses_index = "documents_embedding_idx" in plan
+    if mode == "hybrid":
+        if "documents_content_tsv_idx" in plan:
+            print("\n✅ Full-text search uses the GIN index")
+        else:
+            print("\n⚠️  Full-text search is a sequential scan - check documents_content_tsv_idx exists")
+    if uses_index:
+        print("\n✅ Search uses the vector index")
+    else:
+        print("\n⚠️  Search is a sequential scan - run the encoder to build the vector index")
+    return uses_index
+
+reranker = None
+
+def get_reranker():
+    """Return the process-wide cross-encoder, loaded on first use."""
+    global reranker
+    if reranker is None:
+        logger.info(f"Loading re-ranking model {RERANK_MODEL}...")
+        reranker = Reranker()
+    return reranker
+
+def rerank_results(query, results, limit, budget_ms=DEFAULT_BUDGET_MS, verbose=False):
+    """Keep the limit best results by cross-encoder score; falls back to retrieval order on failure."""
+    try:
+        with span("rerank"):
+            kept, stats = get_reranker().rerank(query, results, limit, budget_ms)
+    except Exception as e:
+        logger.warning(f"Re-ranking unavailable, using retrieval order: {e}")
+        return list(results[:limit])
+    if stats["skipped"]:
+        logger.info(f"Re-ranking skipped ({stats['skipped']})")
+    else:
+        logger.info(f"Re-ranked {stats['scored']} of {stats['candidates']} candidates in {stats['elapsed_ms']:.0f}ms, "
+                    f"kept {len(kept)}")
+    if verbose:
+        for i, (content, filename, chunk_idx, distance, _) in enumerate(kept):
+            logger.info(f"  {i+1}. {filename}[{chunk_idx}] (distance: {distance:.3f})")
+    return kept
+
+def retrieve(store, query_vector, query, args):
+    """Search for args.limit chunks, re-ranking a wider candidate set first with --rerank."""
+    filters = search_filter(args)
+    if not args.rerank:
+        return search_documents(store, query_vector, args.limit, args.verbose, args.ef_search, args.probes,
+                                args.mode, query, filters)
+    candidates = search_documents(store, query_vector, max(args.rerank_candidates, args.limit), args.verbose,
+                                  args.ef_search, args.probes, args.mode, query, filters)
+    return rerank_results(query, candidates, args.limit, args.rerank_budget_ms, args.verbose)
+
+def encode_query(query, model=None):
+    """Embed a query, loading the model if one is not passed in."""
+    if model is None:
+        logger.info("Loading embedding model...")
+        model = load_embedding_model()
+    logger.info("Encoding query...")
+    with span("query_encode"):
+        return model.encode([query])[0].tolist()
+
+def retrieve_relevant_chunks(query, limit=5, verbose=False, model=None, store=None, ef_search=None, probes=None,
+                             mode="vector", rerank_candidates=None, filters=None):
+    """Retrieve relevant document chunks using vector similarity (or hybrid vector + full-text).
+
+    A long-lived caller passes its warm model and an open VectorStore;
+    otherwise the model and a pgvector connection are created for this call.
+    With rerank_candidates, that many chunks are retrieved and cross-encoder
+    re-ranked down to limit.
+    """
+    try:
+        query_vector = encode_query(query, model)
+    except Exception as e:
+        logger.error(f"Failed to load model: {e}")
         return []
     
-    try:
-        cur = conn.cursor()
-        
-        # Check if we have any documents
-        cur.execute("SELECT COUNT(*) FROM documents;")
-        doc_count = cur.fetchone()[0]
-        
-        if doc_count == 0:
-            logger.warning("No documents found in database. Run the encoder service first.")
+    own_store = store is None
+    if own_store:
+        store = open_vector_store()
+        if not store:
             return []
-        
-        logger.info(f"Searching through {doc_count} document chunks...")
-        
-        # Retrieve similar chunks using cosine distance
-        cur.execute("""
-            SELECT content, filename, chunk_index, 
-                   (embedding <#> %s) as distance
-            FROM documents
-            ORDER BY embedding <#> %s
-            LIMIT %s;
-        """, (query_vector, query_vector, limit))
-        
-        results = cur.fetchall()
-        
-        if verbose:
-            logger.info(f"Retrieved {len(results)} relevant chunks:")
-            for i, (content, filename, chunk_idx, distance) in enumerate(results):
-                logger.info(f"  {i+1}. {filename}[{chunk_idx}] (distance: {distance:.3f})")
-        
+    
+    try:
+        results = search_documents(store, query_vector, max(rerank_candidates or 0, limit), verbose,
+                                   ef_search, probes, mode, query, filters)
+        if rerank_candidates:
+            results = rerank_results(query, results, limit, verbose=verbose)
         return [result[0] for result in results]  # Return just the content
         
     except Exception as e:
         logger.error(f"Database query failed: {e}")
+        if not own_store:
+            store.rollback()
         return []
     finally:
-        conn.close()
+        if own_store:
+            store.close()
+
+def build_prompt(query, chunks, model_name="gemma:2b", max_tokens=None):
+    """Pack the retrieved (content, filename, chunk_index) chunks into the LLM prompt."""
+    with span("prompt_build"):
+        context, stats = build_context(chunks, model_name, max_tokens)
+    logger.info(f"Context: {stats['chunks']} chunks packed into {stats['blocks']} blocks, "
+                f"~{stats['tokens_out']} tokens (saved ~{stats['tokens_saved']})")
+    return PROMPT_TEMPLATE.format(context=context, query=query), context
+
+llm_client = None
+
+def get_llm_client():
+    """Return the process-wide Ollama client (pooled connections), created on first use."""
+    global llm_client
+    if llm_client is None:
+        llm_client = OllamaClient(OLLAMA_URL, LLM_KEEP_ALIVE, LLM_MAX_CONCURRENCY)
+    return llm_client
+
+def report_generation_stats(stats):
+    """Log prompt evaluation, time-to-first-token and generation throughput separately, and record them."""
+    if stats.get("ttft") is not None:
+        METRICS.record("llm_ttft", stats["ttft"])
+    if stats.get("total") is not None:
+        METRICS.record("llm_generation", stats["total"] - (stats.get("ttft") or 0))
+    if stats.get("prompt_eval_time") is not None:
+        METRICS.observe("llm_prompt_eval_seconds", stats["prompt_eval_time"])
+    METRICS.inc("llm_tokens_total", stats.get("eval_count") or 0)
+    if stats.get("prompt_eval_time") is not None:
+        logger.info(f"Prompt eval: {stats.get('prompt_eval_count') or 0} tokens in {stats['prompt_eval_time']:.2f}s")
+    if stats.get("ttft") is not None:
+        logger.info(f"Time to first token: {stats['ttft']:.2f}s")
+    if stats.get("tokens_per_sec"):
+        logger.info(f"Generation: {stats['eval_count']} tokens at {stats['tokens_per_sec']:.1f} tokens/s "
+                    f"(total {stats['total']:.2f}s)")
+
+def stream_llm(prompt, model_name="gemma:2b", on_token=None):
+    """Stream a generation from Ollama, calling on_token for each piece as it arrives.
 
-def query_llm(prompt, model_name="gemma:2b"):
-    """Send prompt to Ollama LLM and get response."""
+    Returns (answer, stats); see OllamaClient for the stats fields.
+    """
+    return get_llm_client().generate(prompt, model_name, SYSTEM_PROMPT, stream=True, on_token=on_token)
+
+def query_llm(prompt, model_name="gemma:2b", stream=False, on_token=None, session=None, context_tokens=None,
+              question=None):
+    """Send prompt to Ollama LLM and get response.
+
+    With stream=True tokens are passed to on_token as they are generated; the
+    full answer is returned either way. A ChatSession sends the prompt as the
+    next turn of its conversation instead, remembering only question. context_tokens
+    is the --context-tokens budget the prompt was packed for; it sizes the model's
+    context window.
+    """
+    import requests
     try:
         logger.info(f"Querying {model_name} model...")
         
-        response = requests.post(
-            "http://localhost:11434/api/generate",
-            json={
-                "model": model_name,
-                "prompt": prompt,
-                "stream": False
-            },
-            timeout=120  # 2 minute timeout
-        )
-        
-        if response.status_code == 200:
-            return response.json().get("response", "No response received")
+        if session is not None:
+            answer, stats = session.ask(prompt, stream, on_token, question)
         else:
-            logger.error(f"LLM request failed with status {response.status_code}")
-            return f"Error: LLM service returned status {response.status_code}"
+            answer, stats = get_llm_client().generate(prompt, model_name, SYSTEM_PROMPT, stream, on_token,
+                                                      context_tokens)
+        report_generation_stats(stats)
+        return answer or "No response received"
             
     except requests.exceptions.ConnectionError:
         logger.error("Cannot connect to Ollama service")
@@ -127,54 +398,400 @@ def query_llm(prompt, model_name="gemma:2b"):
         logger.error(f"LLM request failed: {e}")
         return f"Error: {e}"
 
-def main():
-    """Main function to run the RAG query."""
-    args = parse_arguments()
+def query_server(server_url, query, args):
+    """Answer through a running rag_server.py; returns None if it cannot be reached.
+
+    The search, re-ranking, quantization and context settings in args are sent
+    along, overriding the server's own for this request.
+    """
+    import requests
+    request = {"query": query, "limit": args.limit, "model": args.model, "ef_search": args.ef_search,
+               "probes": args.probes, "mode": args.mode, "context_tokens": args.context_tokens}
+    if args.rerank:
+        request.update(rerank_candidates=args.rerank_candidates, rerank_budget_ms=args.rerank_budget_ms)
+    if args.quantization:
+        request.update(quantization=args.quantization, rerank_factor=args.rerank_factor)
+    filters = search_filter(args)
+    if filters:
+        request.update(path=filters.path, types=list(filters.file_types), tags=list(filters.tags),
+                       since=filters.since.isoformat() if filters.since else None)
+    try:
+        response = requests.post(
+            f"{server_url.rstrip('/')}/query",
+            json=request,
+            timeout=180
+        )
+    except requests.exceptions.ConnectionError:
+        logger.warning(f"Query server not reachable at {server_url}, answering locally")
+        return None
     
-    if args.verbose:
-        logging.getLogger().setLevel(logging.DEBUG)
+    if response.status_code != 200:
+        logger.warning(f"Query server returned status {response.status_code}, answering locally")
+        return None
+    return response.json()
+
+def print_no_documents():
+    """Explain why no answer could be produced."""
+    print("❌ No relevant documents found. Make sure you have:")
+    print("   1. Added documents to the data/ folder")
+    print("   2. Run 'docker compose up' to process them")
+
+def print_context(context):
+    """Show the context that was sent to the LLM."""
+    print("\n" + "="*50)
+    print("CONTEXT SENT TO LLM:")
+    print("="*50)
+    print(context)
+    print("="*50 + "\n")
+
+def print_answer(answer):
+    """Display the LLM's answer."""
+    print("\n🤖 Answer:")
+    print("-" * 40)
+    print(answer)
+    print()
+
+def generate_answer(prompt, model_name, stream=True, session=None, context_tokens=None, question=None):
+    """Query the LLM and display the answer, streaming tokens if requested."""
+    if not stream:
+        answer = query_llm(prompt, model_name, session=session, context_tokens=context_tokens, question=question)
+        print_answer(answer)
+        return answer
     
+    # Print tokens as they arrive; errors come back as the answer text instead
+    print("\n🤖 Answer:")
+    print("-" * 40)
+    streamed = []
+    def print_token(token):
+        streamed.append(token)
+        sys.stdout.write(token)
+        sys.stdout.flush()
+    answer = query_llm(prompt, model_name, stream=True, on_token=print_token, session=session,
+                       context_tokens=context_tokens, question=question)
+    if not streamed:
+        print(answer, end="")
+    print("\n")
+    return answer
+
+def run_local_query(args, cache=None):
+    """Retrieve and generate in this process, consulting the query cache when given."""
     query = args.query
-    logger.info(f"Processing query: '{query}'")
+    METRICS.inc("queries_total")
     
-    # Retrieve relevant chunks
-    relevant_chunks = retrieve_relevant_chunks(query, args.limit, args.verbose)
+    # Level 1: a repeated question reuses its embedding and never loads the model
+    embedding_version = model_version(EMBEDDING_MODEL, EMBEDDING_BACKEND)
+    query_vector = cache.get_embedding(query, embedding_version) if cache else None
+    if query_vector is not None:
+        logger.info("Using cached query embedding")
+        METRICS.inc("cache_hits_total", level="embedding")
+    else:
+        try:
+            query_vector = encode_query(query)
+        except Exception as e:
+            logger.error(f"Failed to load model: {e}")
+            return
+        if cache:
+            cache.put_embedding(query, embedding_version, query_vector)
     
-    if not relevant_chunks:
-        print("❌ No relevant documents found. Make sure you have:")
-        print("   1. Added documents to the data/ folder")
-        print("   2. Run 'docker compose up' to process them")
+    store = open_vector_store(args.store, args.quantization, args.rerank_factor)
+    if not store:
         return
     
-    # Build context from retrieved chunks
-    context = "\n---\n".join(relevant_chunks)
+    try:
+        version = None
+        if cache:
+            try:
+                version = store.version()
+            except Exception as e:
+                logger.warning(f"Answer cache disabled, corpus version unavailable: {e}")
+                store.rollback()
+        
+        # Level 2a: a near-duplicate of an already answered question (asked of the whole corpus)
+        if version is not None and args.cache_similarity and not search_filter(args):
+            similar = cache.find_similar_answer(query_vector, args.model, CACHE_TEMPLATE, version)
+            if similar:
+                answer, similarity = similar
+                logger.info(f"Answer served from cache (similar question, similarity {similarity:.3f})")
+                METRICS.inc("cache_hits_total", level="similar_answer")
+                print_answer(answer)
+                return
+        
+        rows = retrieve(store, query_vector, query, args)
+    except Exception as e:
+        logger.error(f"Database query failed: {e}")
+        return
+    finally:
+        store.close()
+    
+    if not rows:
+        print_no_documents()
+        return
+    
+    # Build context and prompt from retrieved chunks
+    prompt, context = build_prompt(query, [row[:3] for row in rows], args.model, args.context_tokens)
+    
+    if args.verbose:
+        print_context(context)
     
-    # Create prompt for LLM
-    prompt = f"""Use the following context to answer the question. Be specific and helpful.
-If you cannot answer based on the context, say so clearly.
+    # Level 2b: this exact prompt (question and packed context) was already sent to this model
+    answer_key = QueryCache.answer_key(args.model, SYSTEM_PROMPT, prompt)
+    if version is not None:
+        cached = cache.get_answer(answer_key, version)
+        if cached is not None:
+            logger.info("Answer served from cache")
+            METRICS.inc("cache_hits_total", level="answer")
+            print_answer(cached)
+            return
+    
+    answer = generate_answer(prompt, args.model, args.stream, context_tokens=args.context_tokens)
+    
+    if version is not None and not answer.startswith("Error:"):
+        cache.put_answer(answer_key, args.model, CACHE_TEMPLATE, version, query_vector, answer)
 
-Context:
-{context}
+def load_questions(path):
+    """Read a JSONL file of {"id": ..., "query": ...} objects (plain strings are accepted too).
 
-Question: {query}
+    Lines that are not valid JSON or have no non-empty query are skipped with a warning.
+    """
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning(f"Skipping line {line_no} of {path}: invalid JSON ({e})")
+                continue
+            if isinstance(item, str):
+                item = {"query": item}
+            if not isinstance(item, dict) or not isinstance(item.get("query"), str) or not item["query"].strip():
+                logger.warning(f"Skipping line {line_no} of {path}: no \"query\" string")
+                continue
+            item.setdefault("id", line_no)
+            questions.append(item)
+    return questions
 
-Answer:"""
+def write_results(results, output=None):
+    """Write batch results as JSONL to output, or to stdout."""
+    out = open(output, "w", encoding="utf-8") if output else sys.stdout
+    try:
+        for result in results:
+            out.write(json.dumps(result) + "\n")
+    finally:
+        if output:
+            out.close()
+
+def run_batch(args):
+    """Answer a file of questions: one batched encode, one connection, bounded concurrent LLM calls.
+
+    A question whose search or generation fails gets an "error" field; every
+    question still gets its line in the output.
+    """
+    questions = load_questions(args.batch)
+    if not questions:
+        logger.warning(f"No questions found in {args.batch}")
+        return
+    logger.info(f"Answering {len(questions)} questions from {args.batch}")
+    results = [{"id": q["id"], "query": q["query"], "timings": {}} for q in questions]
+    METRICS.inc("queries_total", len(questions))
+    
+    def fail_all(error):
+        for result in results:
+            result.update(answer=None, error=error)
+        write_results(results, args.output)
+    
+    start = time.perf_counter()
+    try:
+        model = load_embedding_model()
+    except Exception as e:
+        logger.error(f"Failed to load model: {e}")
+        fail_all(f"embedding model unavailable: {e}")
+        return
+    model_load = time.perf_counter() - start
+    
+    # One forward pass over every question
+    start = time.perf_counter()
+    with span("query_encode", batch=len(questions)):
+        query_vectors = model.encode([q["query"] for q in questions], batch_size=64)
+    encode_each = (time.perf_counter() - start) / len(questions)
+    
+    store = open_vector_store(args.store, args.quantization, args.rerank_factor)
+    if not store:
+        fail_all(f"vector store {args.store} unavailable")
+        return
+    try:
+        for result, query_vector in zip(results, query_vectors):
+            start = time.perf_counter()
+            result["timings"]["encode"] = encode_each
+            try:
+                rows = retrieve(store, query_vector.tolist(), result["query"], args)
+            except Exception as e:
+                logger.error(f"Database query failed for question {result['id']}: {e}")
+                store.rollback()
+                result["error"] = f"search failed: {e}"
+                rows = []
+            result["timings"]["search"] = time.perf_counter() - start
+            result["chunks"] = [{"id": chunk_id, "filename": filename, "chunk_index": chunk_idx, "distance": distance}
+                                for _, filename, chunk_idx, distance, chunk_id in rows]
+            result["prompt"] = build_prompt(result["query"], [row[:3] for row in rows], args.model,
+                                            args.context_tokens)[0] if rows else None
+    finally:
+        store.close()
+    
+    def generate(result):
+        prompt = result.pop("prompt")
+        if prompt is None:
+            result["answer"] = None
+            return
+        start = time.perf_counter()
+        try:
+            answer = query_llm(prompt, args.model, context_tokens=args.context_tokens)
+        except Exception as e:
+            answer = f"Error: {e}"
+        result["timings"]["llm"] = time.perf_counter() - start
+        # query_llm reports failures as the answer text
+        if answer.startswith("Error:"):
+            result.update(answer=None, error=answer[len("Error:"):].strip())
+        else:
+            result["answer"] = answer
+    
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max(1, args.concurrency)) as pool:
+        list(pool.map(generate, results))
+    generation = time.perf_counter() - start
+    
+    write_results(results, args.output)
+    
+    failed = sum(1 for result in results if "error" in result)
+    if failed:
+        logger.warning(f"{failed} of {len(questions)} questions failed; see their \"error\" fields")
+    logger.info(f"Batch done: model load {model_load:.2f}s, encode {encode_each * len(questions):.2f}s, "
+                f"search {sum(r['timings'].get('search', 0) for r in results):.2f}s, "
+                f"generation {generation:.2f}s wall for {len(questions)} questions")
+
+def run_chat(args):
+    """Answer questions interactively as one /api/chat conversation.
+
+    Each question retrieves its own context, sent with that turn only; earlier
+    questions and answers stay in the conversation, and the context budget
+    shrinks by what they take up.
+    """
+    try:
+        model = load_embedding_model()
+    except Exception as e:
+        logger.error(f"Failed to load model: {e}")
+        return
+    store = open_vector_store(args.store, args.quantization, args.rerank_factor)
+    if not store:
+        return
+    
+    session = ChatSession(get_llm_client(), args.model, SYSTEM_PROMPT, context_tokens=args.context_tokens)
+    question = args.query
+    print("💬 Ask a question (empty line or Ctrl-D to quit)")
+    try:
+        while True:
+            if not question:
+                try:
+                    question = input("\n❓ ").strip()
+                except EOFError:
+                    break
+                if not question:
+                    break
+            try:
+                rows = retrieve(store, model.encode([question])[0].tolist(), question, args)
+            except Exception as e:
+                logger.error(f"Database query failed: {e}")
+                rows = []
+            finally:
+                # Nothing was written; end the read transaction so the next question sees new documents
+                store.rollback()
+            if rows:
+                budget = max(context_budget(args.model, args.context_tokens) - session.history_tokens(), 256)
+                prompt, context = build_prompt(question, [row[:3] for row in rows], args.model, budget)
+                if args.verbose:
+                    print_context(context)
+            else:
+                # Nothing new retrieved; the question may still be answerable from earlier turns
+                prompt = question
+            generate_answer(prompt, args.model, args.stream, session, args.context_tokens, question)
+            question = None
+    finally:
+        store.close()
+
+def main():
+    """Main function to run the RAG query."""
+    global LLM_KEEP_ALIVE, LLM_MAX_CONCURRENCY, EMBEDDING_BACKEND, EMBEDDING_THREADS
+    args = parse_arguments()
+    LLM_KEEP_ALIVE = args.keep_alive
+    EMBEDDING_BACKEND, EMBEDDING_THREADS = args.embedding_backend, args.embedding_threads
+    LLM_MAX_CONCURRENCY = max(LLM_MAX_CONCURRENCY, args.concurrency)
     
     if args.verbose:
-        print("\n" + "="*50)
-        print("CONTEXT SENT TO LLM:")
-        print("="*50)
-        print(context)
-        print("="*50 + "\n")
+        logging.getLogger().setLevel(logging.DEBUG)
     
-    # Query the LLM
-    answer = query_llm(prompt, args.model)
+    try:
+        with profile(args.profile) if args.profile else nullcontext():
+            run(args)
+    finally:
+        if args.metrics:
+            METRICS.write(args.metrics)
+            logger.info(f"Metrics written to {args.metrics}")
+        if args.verbose:
+            for line in METRICS.summary():
+                logger.info(f"Stage {line}")
+
+def run(args):
+    """Answer a single query, a batch or a chat session as the arguments ask."""
+    if args.batch:
+        run_batch(args)
+        return
     
-    # Display result
-    print("\n🤖 Answer:")
-    print("-" * 40)
-    print(answer)
-    print()
+    if args.chat:
+        run_chat(args)
+        return
+    
+    query = args.query
+    logger.info(f"Processing query: '{query}'")
+    
+    if args.explain:
+        store = open_vector_store(args.store, args.quantization, args.rerank_factor)
+        if store:
+            try:
+                explain_search(store, encode_query(query), args.limit, args.ef_search, args.probes,
+                               args.mode, query, search_filter(args))
+            finally:
+                store.close()
+        return
+    
+    if args.server and args.store != "pgvector":
+        logger.warning(f"The query server searches pgvector, not --store {args.store}; answering locally")
+    elif args.server:
+        # The server answers in one response, as with --no-stream
+        result = query_server(args.server, query, args)
+        if result is not None:
+            if not result.get("chunks"):
+                print_no_documents()
+                return
+            if args.verbose:
+                print_context(result["context"])
+            print_answer(result["answer"])
+            return
+    
+    cache = None
+    if not args.no_cache:
+        try:
+            cache = QueryCache(similarity_threshold=args.cache_similarity or 1.0)
+            if args.clear_cache:
+                cache.clear()
+        except Exception as e:
+            logger.warning(f"Query cache unavailable: {e}")
+    
+    try:
+        run_local_query(args, cache)
+    finally:
+        if cache:
+            cache.close()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,169 @@
+"""
+Two-level on-disk cache for rag.py.
+
+Level 1 maps normalized query text to its embedding, so repeated questions skip
+loading and running the sentence transformer. Level 2 maps (LLM model, rendered
+prompt) to the generated answer, so only the same question asked over the same
+packed context hits; an optional near-duplicate lookup by query-embedding
+similarity is the only reuse across questions.
+
+Both levels live in one SQLite file and are bounded by entry count (LRU) and age
+(TTL). Answers are tagged with the vector store's corpus version (the database bumps it
+on every change to the documents table), so re-running the encoder invalidates them.
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.getenv("RAG_CACHE_PATH", str(Path.home() / ".cache" / "rag-poc" / "cache.sqlite3"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS query_embeddings (
+    key TEXT PRIMARY KEY,
+    embedding BLOB NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS answers (
+    key TEXT PRIMARY KEY,
+    llm_model TEXT NOT NULL,
+    template_hash TEXT NOT NULL,
+    corpus_version INTEGER NOT NULL,
+    query_embedding BLOB NOT NULL,
+    answer TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS answers_lookup_idx ON answers (llm_model, template_hash, corpus_version);
+"""
+
+def normalize_query(query):
+    """Lower-case and collapse whitespace so trivially different spellings share an entry."""
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+def _digest(*parts):
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+def template_hash(template):
+    """Short fingerprint of a prompt template."""
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()[:16]
+
+class QueryCache:
+    """SQLite-backed query embedding and answer cache with LRU/TTL eviction."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_embeddings=10000, max_answers=1000,
+                 ttl=7 * 24 * 3600, similarity_threshold=0.95):
+        self.max_embeddings = max_embeddings
+        self.max_answers = max_answers
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL;")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _evict(self, table, max_entries):
+        """Drop expired entries, then the least recently used beyond max_entries."""
+        self.db.execute(f"DELETE FROM {table} WHERE created_at < ?;", (time.time() - self.ttl,))
+        self.db.execute(f"""
+            DELETE FROM {table} WHERE key IN (
+                SELECT key FROM {table} ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            );
+        """, (max_entries,))
+
+    def _touch(self, table, key):
+        self.db.execute(f"UPDATE {table} SET last_used = ? WHERE key = ?;", (time.time(), key))
+        self.db.commit()
+
+    # Level 1: query text -> embedding
+
+    def get_embedding(self, query, embedding_model):
+        """Return the cached embedding for a query, or None."""
+        key = _digest(embedding_model, normalize_query(query))
+        row = self.db.execute(
+            "SELECT embedding FROM query_embeddings WHERE key = ? AND created_at >= ?;",
+            (key, time.time() - self.ttl)
+        ).fetchone()
+        if row is None:
+            return None
+        self._touch("query_embeddings", key)
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def put_embedding(self, query, embedding_model, embedding):
+        """Store a query embedding."""
+        key = _digest(embedding_model, normalize_query(query))
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO query_embeddings (key, embedding, created_at, last_used) VALUES (?, ?, ?, ?);",
+            (key, np.asarray(embedding, dtype=np.float32).tobytes(), now, now)
+        )
+        self._evict("query_embeddings", self.max_embeddings)
+        self.db.commit()
+
+    # Level 2: (model, rendered prompt) -> answer
+
+    @staticmethod
+    def answer_key(llm_model, system_prompt, prompt):
+        """Key for an answer to this exact prompt: system prompt, packed context and question."""
+        return _digest(llm_model, system_prompt, prompt)
+
+    def get_answer(self, key, version):
+        """Return the cached answer for a retrieval result, or None."""
+        row = self.db.execute(
+            "SELECT answer FROM answers WHERE key = ? AND corpus_version = ? AND created_at >= ?;",
+            (key, version, time.time() - self.ttl)
+        ).fetchone()
+        if row is None:
+            return None
+        self._touch("answers", key)
+        return row[0]
+
+    def find_similar_answer(self, query_embedding, llm_model, prompt_template, version):
+        """Return (answer, similarity) for the closest cached question above the threshold, or None."""
+        rows = self.db.execute("""
+            SELECT key, query_embedding, answer FROM answers
+            WHERE llm_model = ? AND template_hash = ? AND corpus_version = ? AND created_at >= ?;
+        """, (llm_model, template_hash(prompt_template), version, time.time() - self.ttl)).fetchall()
+        if not rows:
+            return None
+        matrix = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+        query = np.asarray(query_embedding, dtype=np.float32)
+        similarities = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-12)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+        self._touch("answers", rows[best][0])
+        return rows[best][2], float(similarities[best])
+
+    def put_answer(self, key, llm_model, prompt_template, version, query_embedding, answer):
+        """Store a generated answer."""
+        now = time.time()
+        self.db.execute("""
+            INSERT OR REPLACE INTO answers
+            (key, llm_model, template_hash, corpus_version, query_embedding, answer, created_at, last_used)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+        """, (key, llm_model, template_hash(prompt_template), version,
+              np.asarray(query_embedding, dtype=np.float32).tobytes(), answer, now, now))
+        # Answers for an older corpus can never be served again
+        self.db.execute("DELETE FROM answers WHERE corpus_version <> ?;", (version,))
+        self._evict("answers", self.max_answers)
+        self.db.commit()
+
+    def clear(self):
+        """Remove every cached entry."""
+        self.db.execute("DELETE FROM query_embeddings;")
+        self.db.execute("DELETE FROM answers;")
+        self.db.commit()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+RAG Query Server - keeps the embedding model warm and database connections pooled
+Usage: python rag_server.py [--host 127.0.0.1] [--port 8765]
+
+Then query through it with:
+    python rag.py --server http://127.0.0.1:8765 "Your question here"
+
+Per-stage latency histograms and counters are served in the Prometheus text
+format on GET /metrics.
+"""
+
+import os
+import argparse
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from psycopg2.pool import ThreadedConnectionPool
+
+import rag
+from metrics import METRICS, span
+from vectorstore import DEFAULT_RERANK_FACTOR, PG_QUANTIZED_EXPRESSIONS, PgVectorStore
+
+logger = logging.getLogger(__name__)
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Serve RAG queries from a warm, long-lived process')
+    parser.add_argument('--host', default=os.getenv("RAG_SERVER_HOST", "127.0.0.1"),
+                        help='Interface to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=int(os.getenv("RAG_SERVER_PORT", "8765")),
+                        help='Port to listen on (default: 8765)')
+    parser.add_argument('--pool-size', type=int, default=4,
+                        help='Maximum pooled database connections (default: 4)')
+    parser.add_argument('--quantization', choices=['none', 'halfvec', 'binary'],
+                        default=os.getenv("RAG_QUANTIZATION", "none"),
+                        help='Search the quantized index built by embed.py --quantization (default: none)')
+    parser.add_argument('--rerank-factor', type=int, default=DEFAULT_RERANK_FACTOR,
+                        help=f'Quantized candidates re-ranked per result (default: {DEFAULT_RERANK_FACTOR})')
+    parser.add_argument('--embedding-backend', choices=rag.BACKENDS, default=rag.DEFAULT_BACKEND,
+                        help=f'Runtime for the query embedding model (default: {rag.DEFAULT_BACKEND})')
+    parser.add_argument('--embedding-threads', type=int, default=rag.DEFAULT_THREADS,
+                        help='CPU threads for the embedding model, 0 for the runtime default (default: 0)')
+    parser.add_argument('--preload', metavar='LLM_MODEL',
+                        help='Load this Ollama model at startup and keep it resident (e.g. gemma:2b)')
+    parser.add_argument('--rerank-candidates', type=int, default=0,
+                        help=f'Retrieve this many chunks and re-rank them with {rag.RERANK_MODEL}, 0 to disable '
+                             f'(default: 0; e.g. {rag.DEFAULT_CANDIDATES})')
+    parser.add_argument('--rerank-budget-ms', type=float, default=rag.DEFAULT_BUDGET_MS,
+                        help=f'Stop scoring candidates after about this long (default: {rag.DEFAULT_BUDGET_MS:g})')
+    parser.add_argument('--keep-alive', default=rag.DEFAULT_KEEP_ALIVE,
+                        help='How long Ollama keeps the model loaded, e.g. 30m or -1 (default: 30m)')
+    parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose output')
+    return parser.parse_args()
+
+class RAGService:
+    """Holds the embedding model and a connection pool for the lifetime of the server."""
+
+    def __init__(self, pool_size=4, quantization="none", rerank_factor=DEFAULT_RERANK_FACTOR,
+                 rerank_candidates=0, rerank_budget_ms=rag.DEFAULT_BUDGET_MS):
+        logger.info(f"Loading embedding model ({rag.EMBEDDING_BACKEND} backend)...")
+        self.model = rag.load_embedding_model()
+        # The fast tokenizer cannot be used from two threads at once
+        self.encode_lock = threading.Lock()
+        logger.info("Opening database connection pool...")
+        self.pool = ThreadedConnectionPool(1, pool_size, **rag.DB_CONFIG)
+        # getconn() raises PoolError once every connection is out; wait for one instead
+        self.pool_slots = threading.BoundedSemaphore(pool_size)
+        self.stores = {}  # pooled connection -> {(quantization, rerank_factor): PgVectorStore}
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        self.rerank_candidates = rerank_candidates
+        self.rerank_budget_ms = rerank_budget_ms
+        # The cross-encoder's tokenizer has the same restriction
+        self.rerank_lock = threading.Lock()
+        if rerank_candidates:
+            rag.get_reranker()
+
+    def store_for(self, conn, quantization=None, rerank_factor=None):
+        """The store bound to a pooled connection, kept so its prepared search statements are reused."""
+        settings = (quantization or self.quantization, rerank_factor or self.rerank_factor)
+        stores = self.stores.setdefault(conn, {})
+        store = stores.get(settings)
+        if store is None:
+            store = stores[settings] = PgVectorStore(conn, quantization=settings[0], rerank_factor=settings[1])
+        return store
+
+    def retrieve(self, query, limit=5, verbose=False, ef_search=None, probes=None, mode="vector", filters=None,
+                 rerank_candidates=None, rerank_budget_ms=None, quantization=None, rerank_factor=None):
+        """Return the closest chunks as dicts with content, filename, chunk_index and distance.
+
+        The rerank and quantization arguments override the server's settings for this
+        request; rerank_candidates=0 turns re-ranking off. The cross-encoder is loaded on
+        the first request that asks for it.
+        """
+        METRICS.inc("queries_total")
+        if rerank_candidates is None:
+            rerank_candidates = self.rerank_candidates
+        if rerank_budget_ms is None:
+            rerank_budget_ms = self.rerank_budget_ms
+        with self.encode_lock, span("query_encode"):
+            query_vector = self.model.encode([query])[0].tolist()
+        with self.pool_slots:
+            conn = self.pool.getconn()
+            try:
+                store = self.store_for(conn, quantization, rerank_factor)
+                rows = rag.search_documents(store, query_vector, max(rerank_candidates, limit), verbose,
+                                            ef_search, probes, mode, query, filters)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                if conn.closed:
+                    self.stores.pop(conn, None)
+                self.pool.putconn(conn, close=bool(conn.closed))
+        if rerank_candidates:
+            with self.rerank_lock:
+                rows = rag.rerank_results(query, rows, limit, rerank_budget_ms, verbose)
+        return [
+            {"id": chunk_id, "content": content, "filename": filename,
+             "chunk_index": chunk_index, "distance": distance}
+            for content, filename, chunk_index, distance, chunk_id in rows
+        ]
+
+    def answer(self, query, limit=5, model_name="gemma:2b", verbose=False, ef_search=None, probes=None,
+               mode="vector", filters=None, context_tokens=None, **search_settings):
+        """Run the same retrieve + generate flow as rag.py's main().
+
+        search_settings are the rerank and quantization overrides retrieve() takes.
+        """
+        chunks = self.retrieve(query, limit, verbose, ef_search, probes, mode, filters, **search_settings)
+        if not chunks:
+            return {"answer": None, "context": "", "chunks": []}
+        prompt, context = rag.build_prompt(
+            query, [(chunk["content"], chunk["filename"], chunk["chunk_index"]) for chunk in chunks], model_name,
+            context_tokens
+        )
+        answer = rag.query_llm(prompt, model_name, context_tokens=context_tokens)
+        return {"answer": answer, "context": context, "chunks": chunks}
+
+    def close(self):
+        self.pool.closeall()
+
+def _optional(request, field, kind):
+    """A request field converted to kind, or None when it is absent or null."""
+    value = request.get(field)
+    return None if value is None else kind(value)
+
+def make_handler(service, verbose=False):
+    """Build a request handler bound to the shared service."""
+
+    class RAGRequestHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, {"status": "ok"})
+            elif self.path == "/metrics":
+                body = METRICS.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path not in ("/query", "/retrieve"):
+                self._send_json(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                query = request["query"]
+                limit = int(request.get("limit", 5))
+                ef_search = request.get("ef_search")
+                probes = request.get("probes")
+                mode = request.get("mode") or "vector"
+                if mode not in rag.SEARCH_MODES:
+                    raise ValueError(f"unknown mode {mode!r}")
+                # Same filters as rag.py --path/--type/--tag/--since; types and tags may be a string or a list
+                types, tags = request.get("types"), request.get("tags")
+                filters = rag.make_filters(
+                    request.get("path"),
+                    [types] if isinstance(types, str) else types,
+                    [tags] if isinstance(tags, str) else tags,
+                    rag.parse_since(request["since"]) if request.get("since") else None,
+                )
+                # Per-request overrides of the server's settings, as rag.py --rerank/--quantization send them
+                search_settings = {
+                    "rerank_candidates": _optional(request, "rerank_candidates", int),
+                    "rerank_budget_ms": _optional(request, "rerank_budget_ms", float),
+                    "quantization": request.get("quantization"),
+                    "rerank_factor": _optional(request, "rerank_factor", int),
+                }
+                if search_settings["quantization"] not in (None, "none", *PG_QUANTIZED_EXPRESSIONS):
+                    raise ValueError(f"unsupported quantization {search_settings['quantization']!r}")
+                context_tokens = _optional(request, "context_tokens", int)
+            except (ValueError, KeyError, argparse.ArgumentTypeError) as e:
+                self._send_json(400, {"error": f"Invalid request: {e}"})
+                return
+
+            try:
+                if self.path == "/retrieve":
+                    self._send_json(200, {"chunks": service.retrieve(query, limit, verbose, ef_search, probes, mode,
+                                                                     filters, **search_settings)})
+                else:
+                    model_name = request.get("model", "gemma:2b")
+                    self._send_json(200, service.answer(query, limit, model_name, verbose, ef_search,
+                                                        probes, mode, filters, context_tokens, **search_settings))
+            except Exception as e:
+                logger.error(f"Query failed: {e}")
+                self._send_json(500, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            logger.debug(f"{self.address_string()} - {format % args}")
+
+    return RAGRequestHandler
+
+def main():
+    """Start the query server and serve until interrupted."""
+    args = parse_arguments()
+
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    rag.EMBEDDING_BACKEND, rag.EMBEDDING_THREADS = args.embedding_backend, args.embedding_threads
+    try:
+        service = RAGService(args.pool_size, args.quantization, args.rerank_factor,
+                             args.rerank_candidates, args.rerank_budget_ms)
+    except Exception as e:
+        logger.error(f"Failed to start query service: {e}")
+        logger.info("Make sure the PostgreSQL service is running: docker compose ps")
+        return
+
+    rag.LLM_KEEP_ALIVE = args.keep_alive
+    if args.preload:
+        try:
+            rag.get_llm_client().preload(args.preload)
+            logger.info(f"Preloaded {args.preload} (keep_alive {args.keep_alive})")
+        except Exception as e:
+            logger.warning(f"Could not preload {args.preload}: {e}")
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service, args.verbose))
+    logger.info(f"RAG query server listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down...")
+    finally:
+        server.server_close()
+        service.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Cross-encoder re-ranking for rag.py.
+
+The bi-encoder search ranks chunks by embedding distance alone, so the best
+chunk for a question is often retrieved but ranked too low to make the cut.
+Raising --limit to compensate makes every prompt longer and generation slower.
+With --rerank, rag.py instead fetches a wider candidate set (cheap: one index
+scan) and Reranker reads each (question, chunk) pair with a small cross-encoder,
+keeping only the best few for the prompt.
+
+Re-ranking is bounded: candidates are scored in batches, best retrieved first,
+and scoring stops once the next batch would exceed the latency budget (the
+rest keep their retrieval order, after the scored ones). It is skipped when the
+top hit is already confidently ahead of the rest.
+"""
+
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+
+# Candidates fetched from the vector store when re-ranking
+DEFAULT_CANDIDATES = 20
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_BUDGET_MS = 500
+
+# The top hit is trusted as-is when it is this close (cosine distance) and this far ahead of the next
+CONFIDENT_DISTANCE = 0.2
+CONFIDENT_MARGIN = 0.1
+
+# Cross-encoder input length in word-pieces: question plus one chunk (chunks are at most 256)
+MAX_LENGTH = 384
+
+
+def is_confident(results, distance=CONFIDENT_DISTANCE, margin=CONFIDENT_MARGIN):
+    """Whether the best hit is close enough and clearly ahead of the second."""
+    if not results or results[0].distance > distance:
+        return False
+    return len(results) == 1 or results[1].distance - results[0].distance >= margin
+
+
+class Reranker:
+    """A sentence-transformers CrossEncoder on CPU, scoring (query, chunk) pairs in batches."""
+
+    def __init__(self, model_name=RERANK_MODEL, batch_size=DEFAULT_BATCH_SIZE, max_length=MAX_LENGTH):
+        # Imported here so runs without --rerank never pay for torch/transformers
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_name, max_length=max_length, device="cpu")
+        self.batch_size = batch_size
+
+    def rerank(self, query, results, keep, budget_ms=DEFAULT_BUDGET_MS):
+        """Return (best keep results, stats) for SearchResult-like rows in retrieval order.
+
+        stats has candidates, scored, skipped (why re-ranking was skipped, or None)
+        and elapsed_ms.
+        """
+        start = time.perf_counter()
+        stats = {"candidates": len(results), "scored": 0, "skipped": None, "elapsed_ms": 0.0}
+        if len(results) <= 1:
+            stats["skipped"] = "too few candidates"
+            return list(results[:keep]), stats
+        if is_confident(results):
+            stats["skipped"] = "confident top hit"
+            return list(results[:keep]), stats
+
+        scores, batch_seconds = [], 0.0
+        for offset in range(0, len(results), self.batch_size):
+            elapsed = time.perf_counter() - start
+            # Always score the first batch; after that, stop before a batch would overrun the budget
+            if scores and budget_ms and (elapsed + batch_seconds) * 1000 > budget_ms:
+                break
+            batch_start = time.perf_counter()
+            pairs = [(query, result.content) for result in results[offset:offset + self.batch_size]]
+            scores.extend(float(score) for score in self.model.predict(pairs, batch_size=self.batch_size,
+                                                                       show_progress_bar=False))
+            batch_seconds = max(batch_seconds, time.perf_counter() - batch_start)
+
+        scored = sorted(range(len(scores)), key=lambda i: -scores[i])
+        ranked = [results[i] for i in scored] + list(results[len(scores):])
+        stats["scored"] = len(scores)
+        stats["elapsed_ms"] = (time.perf_counter() - start) * 1000
+        return ranked[:keep], stats
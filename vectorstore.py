@@ -0,0 +1,875 @@
+"""
+Vector stores shared by the encoder and the query path.
+
+VectorStore is the interface both sides use: add and delete a file's chunks,
+commit, and search by embedding. Results are SearchResult rows
+(content, filename, chunk_index, distance, id), with distance being cosine
+distance as returned by pgvector's <=> operator.
+
+- PgVectorStore keeps chunks in the Postgres documents table, writes them with
+  binary COPY and searches them with pgvector (optionally fused with full-text
+  search, see HYBRID_SEARCH_SQL).
+- NumPyVectorStore keeps them in memory in one contiguous float32 (or float16)
+  matrix and answers with a vectorized exact top-k (argpartition), or through an
+  optional IVF index. It can be saved to and loaded from a directory, so small
+  deployments, notebooks and tests can skip Postgres entirely.
+
+Both can search a quantized copy of the embeddings (halfvec, int8 or binary) for
+limit * rerank_factor candidates and re-rank those by exact cosine distance, so
+the structure scanned on every query is 2x (halfvec), 4x (int8) or 32x (binary)
+smaller than the float32 vectors.
+
+Every chunk carries its file's metadata (FileMetadata: file type, tags and
+mtime; filename is the path relative to the data directory), and searches can
+be scoped with a SearchFilter. Filters are applied while searching, not to a
+global top-k afterwards, so a selective filter still returns limit rows.
+"""
+
+import io
+import os
+import json
+import hashlib
+import struct
+import logging
+from collections import namedtuple
+from datetime import datetime, timezone
+from pathlib import Path, PurePosixPath
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SearchResult = namedtuple("SearchResult", ["content", "filename", "chunk_index", "distance", "id"])
+
+# Stored with every chunk of a file: its suffix without the dot, the folders on its path, its mtime
+FileMetadata = namedtuple("FileMetadata", ["file_type", "tags", "mtime"])
+
+# Scope for a search; unset fields do not filter. path is a folder (or file) relative to the data
+# directory, file_types and tags match any of their values, since is an aware datetime.
+SearchFilter = namedtuple("SearchFilter", ["path", "file_types", "tags", "since"], defaults=(None, (), (), None))
+
+SEARCH_MODES = ("vector", "hybrid")
+
+EMBEDDING_DIM = 384
+
+# Compact copies of the embeddings searched first, before re-ranking on full precision
+QUANTIZATIONS = ("none", "halfvec", "int8", "binary")
+
+# Candidates taken from the compact copy per requested result
+DEFAULT_RERANK_FACTOR = 4
+
+
+def file_metadata(filename, mtime=None):
+    """FileMetadata for a relative path: the suffix as file type and the folders as tags."""
+    path = PurePosixPath(filename)
+    return FileMetadata(path.suffix.lstrip(".").lower(), list(path.parent.parts), mtime)
+
+
+def path_bounds(path):
+    """(folder, lower, upper) for a path filter: the file itself or anything below folder/."""
+    folder = path.strip("/")
+    # "0" sorts right after "/", so [folder/, folder0) holds exactly the paths under folder/
+    return folder, folder + "/", folder + "0"
+
+
+class VectorStore:
+    """Interface implemented by every backend.
+
+    Writes (add/delete) become visible to other readers on commit(); rollback()
+    discards them.
+    """
+
+    def add(self, rows, embeddings, metadata=None):
+        """Store (filename, chunk_index, content) rows with their embeddings.
+
+        metadata maps a filename to its FileMetadata; files missing from it get
+        file_metadata(filename).
+        """
+        raise NotImplementedError
+
+    def delete(self, filenames):
+        """Remove every chunk of the given files."""
+        raise NotImplementedError
+
+    def search(self, query_vector, limit=5, mode="vector", query_text=None, ef_search=None, probes=None,
+               filters=None):
+        """Return the best chunks as SearchResult rows, closest first, among those matching filters."""
+        raise NotImplementedError
+
+    def count(self):
+        """Number of stored chunks."""
+        raise NotImplementedError
+
+    def version(self):
+        """A number that changes whenever the stored chunks change (for cache invalidation)."""
+        raise NotImplementedError
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# pgvector
+
+# PostgreSQL binary COPY framing: signature, flags, header extension length / end marker
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_TRAILER = struct.pack("!h", -1)
+
+COPY_SQL = ("COPY {table} (filename, chunk_index, content, embedding, file_type, tags, mtime) "
+            "FROM STDIN WITH (FORMAT binary)")
+
+COPY_NULL = struct.pack("!i", -1)
+
+# text's type OID, which binary array values name for their elements
+TEXT_OID = 25
+
+# timestamptz is sent as microseconds since 2000-01-01 UTC
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+
+
+def _copy_text_array(values):
+    items = [value.encode("utf-8") for value in values]
+    if not items:
+        body = struct.pack("!iii", 0, 0, TEXT_OID)
+    else:
+        body = struct.pack("!iiiii", 1, 0, TEXT_OID, len(items), 1)
+        body += b"".join(struct.pack("!i", len(item)) + item for item in items)
+    return struct.pack("!i", len(body)) + body
+
+
+def _copy_timestamptz(value):
+    if value is None:
+        return COPY_NULL
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    delta = value - PG_EPOCH
+    return struct.pack("!iq", 8, (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds)
+
+
+def encode_copy_row(filename, chunk_index, content, embedding, metadata=None):
+    """Encode one documents row in binary COPY format (pgvector's vector_recv layout)."""
+    metadata = metadata or file_metadata(filename)
+    name = filename.encode("utf-8")
+    text = content.encode("utf-8")
+    vector = np.asarray(embedding, dtype=">f4").tobytes()
+    file_type = metadata.file_type.encode("utf-8")
+    return b"".join((
+        struct.pack("!hi", 7, len(name)), name,
+        struct.pack("!ii", 4, chunk_index),
+        struct.pack("!i", len(text)), text,
+        struct.pack("!ihh", len(vector) + 4, len(embedding), 0), vector,
+        struct.pack("!i", len(file_type)), file_type,
+        _copy_text_array(metadata.tags),
+        _copy_timestamptz(metadata.mtime),
+    ))
+
+
+def to_vector_literal(vector):
+    """Format an embedding as a pgvector text literal."""
+    # 9 significant digits round-trip float32 exactly, at about half the length of str()
+    return "[" + ",".join("%.9g" % value for value in vector) + "]"
+
+
+# Quantized forms pgvector can index: (indexed expression, query expression, distance operator).
+# The encoder builds its vector index on the same expression so the candidate scan can use it.
+PG_QUANTIZED_EXPRESSIONS = {
+    "halfvec": (f"(embedding::halfvec({EMBEDDING_DIM}))", f"%(vector)s::halfvec({EMBEDDING_DIM})", "<=>"),
+    "binary": (f"(binary_quantize(embedding)::bit({EMBEDDING_DIM}))",
+               f"binary_quantize(%(vector)s::vector)::bit({EMBEDDING_DIM})", "<~>"),
+}
+
+# Nearest chunks by the quantized expression; SEARCH_SQL re-ranks them by exact distance
+PG_CANDIDATES_SQL = """(
+        SELECT id, filename, chunk_index, content, embedding
+        FROM {table}{where}
+        ORDER BY {expression} {operator} {query}
+        LIMIT %(rerank)s
+    ) candidates"""
+
+# Cosine distance, matching the vector_cosine_ops index the encoder builds
+SEARCH_SQL = """
+    SELECT content, filename, chunk_index,
+           embedding <=> %(vector)s::vector AS distance, id
+    FROM {source}{where}
+    ORDER BY distance
+    LIMIT %(limit)s;
+"""
+
+# Reciprocal-rank fusion constant; 60 is the usual choice and damps the weight of the top ranks
+RRF_K = 60
+
+# Hybrid search: the nearest chunks by embedding and the best full-text matches are ranked
+# separately and merged with reciprocal-rank fusion, all in one query. Query words are
+# OR-ed so a single exact identifier is enough for a lexical hit. Distances computed for
+# the vector ranking are reused; only chunks found by full-text search alone are measured.
+HYBRID_SEARCH_SQL = """
+    WITH vector_hits AS (
+        SELECT id, distance, ROW_NUMBER() OVER (ORDER BY distance) AS rank
+        FROM (
+            SELECT id, embedding <=> %(vector)s::vector AS distance
+            FROM {source}{where}
+            ORDER BY distance
+            LIMIT %(candidates)s
+        ) nearest
+    ),
+    text_hits AS (
+        SELECT id, ROW_NUMBER() OVER (ORDER BY score DESC) AS rank
+        FROM (
+            SELECT id, ts_rank_cd(content_tsv, replace(plainto_tsquery('simple', %(query)s)::text, '&', '|')::tsquery) AS score
+            FROM {table}
+            WHERE content_tsv @@ replace(plainto_tsquery('simple', %(query)s)::text, '&', '|')::tsquery{and_where}
+            ORDER BY score DESC
+            LIMIT %(candidates)s
+        ) matched
+    ),
+    fused AS (
+        SELECT id, SUM(1.0 / (%(rrf_k)s + rank)) AS score, MIN(distance) AS distance
+        FROM (
+            SELECT id, rank, distance FROM vector_hits
+            UNION ALL SELECT id, rank, NULL::float8 FROM text_hits
+        ) hits
+        GROUP BY id
+    )
+    SELECT d.content, d.filename, d.chunk_index,
+           COALESCE(fused.distance, d.embedding <=> %(vector)s::vector) AS distance, d.id
+    FROM fused
+    JOIN {table} d USING (id)
+    ORDER BY fused.score DESC, distance
+    LIMIT %(limit)s;
+"""
+
+
+def hybrid_candidates(limit):
+    """How many chunks each of the vector and full-text rankings contributes to the fusion."""
+    return max(limit * 4, 20)
+
+
+def search_settings_sql(ef_search=None, probes=None, iterative=False):
+    """SET LOCAL statements for the ANN tuning knobs (hnsw.ef_search / ivfflat.probes).
+
+    iterative lets a filtered index scan keep going until it has found enough
+    matching rows (pgvector 0.8+), instead of filtering a fixed-size candidate list.
+    """
+    sql = ""
+    if ef_search:
+        sql += f"SET LOCAL hnsw.ef_search = {int(ef_search)}; "
+    if probes:
+        sql += f"SET LOCAL ivfflat.probes = {int(probes)}; "
+    if iterative:
+        # IVFFlat only scans iteratively in relaxed order; search() restores the order
+        sql += "SET LOCAL hnsw.iterative_scan = strict_order; SET LOCAL ivfflat.iterative_scan = relaxed_order; "
+    return sql
+
+
+def filter_conditions(filters):
+    """SQL conditions (with %(name)s parameters) and their values for a SearchFilter."""
+    conditions, params = [], {}
+    if filters is None:
+        return conditions, params
+    if filters.path and filters.path.strip("/"):
+        # A range on text_pattern_ops keeps the prefix match indexable even in a generic plan
+        params["path"], params["path_from"], params["path_to"] = path_bounds(filters.path)
+        conditions.append("(filename = %(path)s OR (filename ~>=~ %(path_from)s AND filename ~<~ %(path_to)s))")
+    if filters.file_types:
+        params["file_types"] = list(filters.file_types)
+        conditions.append("file_type = ANY(%(file_types)s)")
+    if filters.tags:
+        params["tags"] = list(filters.tags)
+        conditions.append("tags && %(tags)s")
+    if filters.since:
+        params["since"] = filters.since
+        conditions.append("mtime >= %(since)s")
+    return conditions, params
+
+
+# Parameter types of the prepared search statements, in $n order
+PREPARED_PARAM_TYPES = {
+    "vector": "vector",
+    "query": "text",
+    "candidates": "integer",
+    "rrf_k": "integer",
+    "rerank": "integer",
+    "path": "text",
+    "path_from": "text",
+    "path_to": "text",
+    "file_types": "text[]",
+    "tags": "text[]",
+    "since": "timestamptz",
+    "limit": "integer",
+}
+
+
+def prepare_sql(sql):
+    """Turn a %(name)s search query into a PREPARE body; returns (name, body, parameter names in $n order).
+
+    The statement name is derived from the query, so every store on a connection shares it.
+    """
+    names = [name for name in PREPARED_PARAM_TYPES if f"%({name})s" in sql]
+    for position, name in enumerate(names, 1):
+        sql = sql.replace(f"%({name})s", f"${position}")
+    body = sql.strip().rstrip(";")
+    return "rag_search_" + hashlib.sha1(body.encode("utf-8")).hexdigest()[:16], body, names
+
+
+class PgVectorStore(VectorStore):
+    """Chunks in a Postgres table with a pgvector embedding column.
+
+    Wraps an open psycopg2 connection; reads and writes share its transaction.
+    With quantization "halfvec" or "binary", candidates come from the matching
+    expression index and are re-ranked on the stored vectors.
+
+    Searches run as server-side prepared statements that live as long as the
+    connection: each is parsed and planned once, and a search is then a single
+    EXECUTE round trip carrying the query vector once. Keep one store per
+    connection so the check for an existing statement is also made only once.
+    """
+
+    def __init__(self, conn, table="documents", quantization="none", rerank_factor=DEFAULT_RERANK_FACTOR):
+        if quantization not in ("none", *PG_QUANTIZED_EXPRESSIONS):
+            raise ValueError(f"pgvector supports quantization none, halfvec or binary, not {quantization!r}")
+        self.conn = conn
+        self.table = table
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        self._prepared = {}  # (mode, sql) -> (statement name, parameter names)
+
+    @classmethod
+    def connect(cls, table="documents", quantization="none", **db_config):
+        import psycopg2
+        return cls(psycopg2.connect(**db_config), table, quantization)
+
+    def _source(self, conditions=()):
+        """(source, where) for the vector ranking: the table, or its quantized candidates, and the
+        WHERE clause still to apply to it."""
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        if self.quantization == "none":
+            return self.table, where
+        expression, query, operator = PG_QUANTIZED_EXPRESSIONS[self.quantization]
+        # Filter while collecting candidates, so every re-ranked candidate matches
+        return PG_CANDIDATES_SQL.format(table=self.table, where=where, expression=expression,
+                                        operator=operator, query=query), ""
+
+    def _settings_sql(self, candidates, ef_search, probes, filtered):
+        # An HNSW scan returns at most ef_search rows, so leave room for every re-rank candidate
+        if self.quantization != "none" and not ef_search and candidates > 40:
+            ef_search = candidates
+        return search_settings_sql(ef_search, probes, iterative=filtered)
+
+    def _statement(self, cur, mode, conditions):
+        """Name and parameter order of the prepared statement for mode, preparing it if needed.
+
+        Each combination of filters gets its own statement, planned for exactly those conditions.
+        """
+        source, where = self._source(conditions)
+        if mode == "hybrid":
+            and_where = "".join(f" AND {condition}" for condition in conditions)
+            sql = HYBRID_SEARCH_SQL.format(table=self.table, source=source, where=where, and_where=and_where)
+        else:
+            sql = SEARCH_SQL.format(source=source, where=where)
+        key = (mode, sql)
+        if key not in self._prepared:
+            name, body, names = prepare_sql(sql)
+            # Another store on this connection may have prepared it already
+            cur.execute("SELECT 1 FROM pg_prepared_statements WHERE name = %s;", (name,))
+            if cur.fetchone() is None:
+                types = ", ".join(PREPARED_PARAM_TYPES[param] for param in names)
+                # Prepared statements belong to the session, so a later rollback keeps them
+                cur.execute(f"PREPARE {name} ({types}) AS {body};")
+            self._prepared[key] = (name, names)
+        return self._prepared[key]
+
+    def add(self, rows, embeddings, metadata=None):
+        metadata = metadata or {}
+        buffer = io.BytesIO()
+        buffer.write(COPY_HEADER)
+        for (filename, chunk_index, content), emb in zip(rows, embeddings):
+            buffer.write(encode_copy_row(filename, chunk_index, content, emb, metadata.get(filename)))
+        buffer.write(COPY_TRAILER)
+        buffer.seek(0)
+        self.conn.cursor().copy_expert(COPY_SQL.format(table=self.table), buffer)
+
+    def delete(self, filenames):
+        self.conn.cursor().execute(f"DELETE FROM {self.table} WHERE filename = ANY(%s);", (list(filenames),))
+
+    def _search_params(self, query_vector, limit, mode, query_text, filter_params):
+        params = {"vector": to_vector_literal(query_vector), "limit": limit, **filter_params}
+        ranked = limit
+        if mode == "hybrid":
+            ranked = hybrid_candidates(limit)
+            params.update(query=query_text or "", candidates=ranked, rrf_k=RRF_K)
+        params["rerank"] = ranked * self.rerank_factor
+        return params
+
+    def execute_search(self, cur, query_vector, limit, mode="vector", query_text=None, explain=False,
+                       ef_search=None, probes=None, filters=None):
+        """Run the vector or hybrid search query on a cursor."""
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) " if explain else ""
+        conditions, filter_params = filter_conditions(filters)
+        params = self._search_params(query_vector, limit, mode, query_text, filter_params)
+        name, names = self._statement(cur, mode, conditions)
+        # The tuning knobs travel in the same round trip as the search
+        sql = self._settings_sql(params["rerank"], ef_search, probes, bool(conditions))
+        sql += f"{prefix}EXECUTE {name} ({', '.join(['%s'] * len(names))});"
+        cur.execute(sql, [params[param] for param in names])
+
+    def search(self, query_vector, limit=5, mode="vector", query_text=None, ef_search=None, probes=None,
+               filters=None):
+        cur = self.conn.cursor()
+        self.execute_search(cur, query_vector, limit, mode, query_text, ef_search=ef_search, probes=probes,
+                            filters=filters)
+        results = [SearchResult(*row) for row in cur.fetchall()]
+        if filters and mode == "vector":
+            # A relaxed-order iterative scan can return neighbours slightly out of order
+            results.sort(key=lambda result: result.distance)
+        return results
+
+    def explain(self, query_vector, limit=5, mode="vector", query_text=None, ef_search=None, probes=None,
+                filters=None):
+        """Return the search's EXPLAIN ANALYZE plan as text."""
+        cur = self.conn.cursor()
+        self.execute_search(cur, query_vector, limit, mode, query_text, explain=True,
+                            ef_search=ef_search, probes=probes, filters=filters)
+        plan = "\n".join(row[0] for row in cur.fetchall())
+        self.conn.rollback()
+        return plan
+
+    def count(self):
+        cur = self.conn.cursor()
+        cur.execute(f"SELECT COUNT(*) FROM {self.table};")
+        return cur.fetchone()[0]
+
+    def version(self):
+        """The documents version that the database bumps on every change."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT version FROM corpus_state;")
+        row = cur.fetchone()
+        self.conn.commit()
+        return row[0] if row else 0
+
+    def iter_chunks(self, batch_size=2000):
+        """Yield (rows, embeddings, metadata) batches of every stored chunk, in id order."""
+        cur = self.conn.cursor(name="vectorstore_export")
+        cur.itersize = batch_size
+        cur.execute(f"SELECT filename, chunk_index, content, embedding::text, file_type, tags, mtime "
+                    f"FROM {self.table} ORDER BY id;")
+        while True:
+            batch = cur.fetchmany(batch_size)
+            if not batch:
+                break
+            rows = [row[:3] for row in batch]
+            embeddings = np.array([row[3][1:-1].split(",") for row in batch], dtype=np.float32)
+            metadata = {row[0]: FileMetadata(row[4] or "", row[5] or [], row[6]) for row in batch}
+            yield rows, embeddings, metadata
+        cur.close()
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+
+# In-process NumPy
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _timestamp(value):
+    """POSIX seconds of a datetime (naive ones are UTC), NaN for None."""
+    if value is None:
+        return np.nan
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _dot(matrix, query, block_rows=65536):
+    """matrix @ query in float32, converting float16 storage a block at a time."""
+    if matrix.dtype == np.float32:
+        return matrix @ query
+    out = np.empty(len(matrix), dtype=np.float32)
+    for start in range(0, len(matrix), block_rows):
+        out[start:start + block_rows] = matrix[start:start + block_rows].astype(np.float32) @ query
+    return out
+
+
+# Set bits in every byte value, for Hamming distance over packed binary codes
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.int32)
+
+
+def quantize(vectors, quantization):
+    """Return (codes, scales) for normalized float32 vectors; scales is None except for int8."""
+    if quantization == "halfvec":
+        return vectors.astype(np.float16), None
+    if quantization == "int8":
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+    if quantization == "binary":
+        return np.packbits(vectors > 0, axis=1), None
+    raise ValueError(f"Unknown quantization {quantization!r}; expected one of {QUANTIZATIONS}")
+
+
+def _approximate_scores(codes, scales, query, quantization, block_rows=65536):
+    """Similarity of each code to the query; higher is closer. Binary codes score -Hamming distance."""
+    if quantization == "binary":
+        query_code = np.packbits(query > 0)
+        out = np.empty(len(codes), dtype=np.int32)
+        for start in range(0, len(codes), block_rows):
+            out[start:start + block_rows] = -_POPCOUNT[codes[start:start + block_rows] ^ query_code].sum(axis=1)
+        return out
+    scores = _dot(codes, query, block_rows)
+    return scores * scales if scales is not None else scores
+
+
+def _top_k(scores, k):
+    """Positions of the k highest scores, best first."""
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+class IVFIndex:
+    """Inverted-file ANN index: spherical k-means centroids and each row's nearest centroid.
+
+    A search scores only the rows of the nprobe lists closest to the query.
+    """
+
+    def __init__(self, centroids, assignments, nprobe):
+        self.centroids = centroids
+        self.assignments = assignments
+        self.nprobe = nprobe
+
+    @classmethod
+    def train(cls, matrix, nlist=None, nprobe=None, iterations=10, sample_size=50000, seed=0):
+        rng = np.random.default_rng(seed)
+        nlist = min(nlist or max(1, int(np.sqrt(len(matrix)))), len(matrix))
+        sample = matrix[rng.choice(len(matrix), min(sample_size, len(matrix)), replace=False)].astype(np.float32)
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            nearest = np.argmax(sample @ centroids.T, axis=1)
+            for list_id in range(nlist):
+                members = sample[nearest == list_id]
+                # Re-seed empty lists from a random sample row
+                centroids[list_id] = members.sum(axis=0) if len(members) else sample[rng.integers(len(sample))]
+            centroids = _normalize(centroids)
+        index = cls(centroids, np.empty(0, dtype=np.int32), nprobe or max(1, nlist // 8))
+        index.assignments = index.assign(matrix)
+        return index
+
+    def assign(self, vectors, block_rows=65536):
+        """Nearest centroid of each row."""
+        out = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), block_rows):
+            block = np.asarray(vectors[start:start + block_rows], dtype=np.float32)
+            out[start:start + block_rows] = np.argmax(block @ self.centroids.T, axis=1)
+        return out
+
+    def candidates(self, query, nprobe=None):
+        """Row positions in the nprobe lists closest to the query."""
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        return np.flatnonzero(np.isin(self.assignments, lists))
+
+
+def _write_replacing(path, write):
+    """Write a file under a temporary name with write(binary file), then os.replace it into place."""
+    temporary = path.with_name(path.name + ".tmp")
+    with open(temporary, "wb") as f:
+        write(f)
+    os.replace(temporary, path)
+
+
+class NumPyVectorStore(VectorStore):
+    """Chunks and their embeddings in process memory.
+
+    Embeddings are normalized and kept in one contiguous matrix (float32, or
+    float16 to halve memory), grown geometrically as rows are added. Writes apply
+    immediately; when the store has a path, commit() saves it if anything changed
+    since it was loaded or saved, and rollback() reloads the last saved state.
+
+    With a quantization other than "none", a compact code per row is kept next to
+    the matrix and scanned first; only the best limit * rerank_factor rows are
+    scored on the matrix. Loaded with mmap=True, the matrix then stays on disk
+    and only the codes and the re-ranked rows are read into memory.
+    """
+
+    def __init__(self, dim=EMBEDDING_DIM, dtype=np.float32, path=None, quantization="none",
+                 rerank_factor=DEFAULT_RERANK_FACTOR):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization!r}; expected one of {QUANTIZATIONS}")
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        self._matrix = np.empty((0, dim), dtype=self.dtype)
+        self._codes, self._scales = self._empty_codes(0)
+        self._size = 0
+        self.contents, self.filenames, self.chunk_indexes, self.ids = [], [], [], []
+        self.file_types, self.tags, self.mtimes = [], [], []  # mtimes as POSIX seconds, NaN if unknown
+        self._next_id = 1
+        self._version = 0
+        self._saved_version = None  # _version as last loaded from or saved to path
+        self._mmap = False
+        self.index = None
+        self._warned_hybrid = False
+
+    @property
+    def matrix(self):
+        return self._matrix[:self._size]
+
+    @property
+    def codes(self):
+        return None if self._codes is None else self._codes[:self._size]
+
+    @property
+    def scales(self):
+        return None if self._scales is None else self._scales[:self._size]
+
+    def _empty_codes(self, rows):
+        if self.quantization == "none":
+            return None, None
+        codes, scales = quantize(np.zeros((1, self.dim), dtype=np.float32), self.quantization)
+        return (np.empty((rows,) + codes.shape[1:], dtype=codes.dtype),
+                None if scales is None else np.empty(rows, dtype=np.float32))
+
+    def _reserve(self, rows):
+        needed = self._size + rows
+        if needed <= len(self._matrix):
+            return
+        capacity = max(needed, 2 * len(self._matrix), 1024)
+        grown = np.empty((capacity, self.dim), dtype=self.dtype)
+        grown[:self._size] = self.matrix
+        self._matrix = grown
+        if self.quantization != "none":
+            codes, scales = self._empty_codes(capacity)
+            codes[:self._size] = self.codes
+            if scales is not None:
+                scales[:self._size] = self.scales
+            self._codes, self._scales = codes, scales
+
+    def _encode(self, block_rows=65536):
+        """(Re)build the quantized codes from the matrix, a block at a time."""
+        self._codes, self._scales = self._empty_codes(self._size)
+        for start in range(0, self._size, block_rows):
+            block = np.asarray(self._matrix[start:min(start + block_rows, self._size)], dtype=np.float32)
+            codes, scales = quantize(block, self.quantization)
+            self._codes[start:start + len(block)] = codes
+            if scales is not None:
+                self._scales[start:start + len(block)] = scales
+
+    def add(self, rows, embeddings, metadata=None):
+        metadata = metadata or {}
+        vectors = _normalize(embeddings).reshape(-1, self.dim)
+        if len(vectors) != len(rows):
+            raise ValueError(f"{len(rows)} rows but {len(vectors)} embeddings")
+        self._reserve(len(rows))
+        self._matrix[self._size:self._size + len(rows)] = vectors
+        if self.quantization != "none":
+            codes, scales = quantize(vectors, self.quantization)
+            self._codes[self._size:self._size + len(rows)] = codes
+            if scales is not None:
+                self._scales[self._size:self._size + len(rows)] = scales
+        self._size += len(rows)
+        for filename, chunk_index, content in rows:
+            info = metadata.get(filename) or file_metadata(filename)
+            self.filenames.append(filename)
+            self.chunk_indexes.append(chunk_index)
+            self.contents.append(content)
+            self.file_types.append(info.file_type)
+            self.tags.append(list(info.tags))
+            self.mtimes.append(_timestamp(info.mtime))
+            self.ids.append(self._next_id)
+            self._next_id += 1
+        if self.index is not None:
+            self.index.assignments = np.concatenate([self.index.assignments, self.index.assign(vectors)])
+        self._version += 1
+
+    def delete(self, filenames):
+        filenames = set(filenames)
+        keep = np.array([name not in filenames for name in self.filenames], dtype=bool)
+        if keep.all():
+            return
+        kept = np.flatnonzero(keep)
+        self._matrix = np.ascontiguousarray(self.matrix[kept])
+        if self.quantization != "none":
+            self._codes = np.ascontiguousarray(self.codes[kept])
+            self._scales = None if self._scales is None else self.scales[kept]
+        self._size = len(kept)
+        self.contents = [self.contents[i] for i in kept]
+        self.filenames = [self.filenames[i] for i in kept]
+        self.chunk_indexes = [self.chunk_indexes[i] for i in kept]
+        self.file_types = [self.file_types[i] for i in kept]
+        self.tags = [self.tags[i] for i in kept]
+        self.mtimes = [self.mtimes[i] for i in kept]
+        self.ids = [self.ids[i] for i in kept]
+        if self.index is not None:
+            self.index.assignments = self.index.assignments[kept]
+        self._version += 1
+
+    def build_index(self, nlist=None, nprobe=None, iterations=10, seed=0):
+        """Train an IVF index; until then (and for tiny stores) searches are exact."""
+        if self._size == 0:
+            self.index = None
+            return
+        self.index = IVFIndex.train(self.matrix, nlist, nprobe, iterations, seed=seed)
+        logger.info(f"Built IVF index with {len(self.index.centroids)} lists over {self._size} chunks")
+
+    def matching(self, filters):
+        """Positions of the rows that match a SearchFilter."""
+        mask = np.ones(self._size, dtype=bool)
+        if filters.path and filters.path.strip("/"):
+            folder, lower, upper = path_bounds(filters.path)
+            mask &= np.fromiter((name == folder or lower <= name < upper for name in self.filenames),
+                                dtype=bool, count=self._size)
+        if filters.file_types:
+            file_types = set(filters.file_types)
+            mask &= np.fromiter((file_type in file_types for file_type in self.file_types),
+                                dtype=bool, count=self._size)
+        if filters.tags:
+            tags = set(filters.tags)
+            mask &= np.fromiter((not tags.isdisjoint(row_tags) for row_tags in self.tags),
+                                dtype=bool, count=self._size)
+        if filters.since:
+            # Unknown mtimes are NaN and never match, like NULL in SQL
+            mask &= np.asarray(self.mtimes, dtype=np.float64) >= _timestamp(filters.since)
+        return np.flatnonzero(mask)
+
+    def search(self, query_vector, limit=5, mode="vector", query_text=None, ef_search=None, probes=None,
+               filters=None):
+        if mode == "hybrid" and not self._warned_hybrid:
+            logger.warning("Hybrid search needs Postgres full-text search; using vector search")
+            self._warned_hybrid = True
+        if self._size == 0 or limit <= 0:
+            return []
+        query = _normalize(query_vector)
+        positions = self.index.candidates(query, probes) if self.index is not None else None
+        if filters:
+            allowed = self.matching(filters)
+            if positions is not None:
+                positions = np.intersect1d(positions, allowed, assume_unique=True)
+            # Too few matches in the probed lists: scan every matching row rather than return short
+            if positions is None or len(positions) < limit:
+                positions = allowed
+            if len(positions) == 0:
+                return []
+        if self.quantization != "none":
+            codes = self.codes if positions is None else self.codes[positions]
+            scales = self.scales if positions is None or self._scales is None else self.scales[positions]
+            shortlist = _top_k(_approximate_scores(codes, scales, query, self.quantization),
+                               limit * self.rerank_factor)
+            positions = shortlist if positions is None else positions[shortlist]
+            # Fancy indexing in sorted order reads an mmapped matrix front to back
+            positions = np.sort(positions)
+        scores = _dot(self.matrix if positions is None else self.matrix[positions], query)
+        results = []
+        for i in _top_k(scores, limit):
+            row = int(i if positions is None else positions[i])
+            results.append(SearchResult(self.contents[row], self.filenames[row], self.chunk_indexes[row],
+                                        float(1.0 - scores[i]), self.ids[row]))
+        return results
+
+    def memory_bytes(self):
+        """Bytes of vector data held in memory: the codes, and the matrix unless it is mmapped."""
+        total = 0 if isinstance(self._matrix, np.memmap) else self.matrix.nbytes
+        if self.quantization != "none":
+            total += self.codes.nbytes + (0 if self._scales is None else self.scales.nbytes)
+        if self.index is not None:
+            total += self.index.centroids.nbytes + self.index.assignments.nbytes
+        return total
+
+    def count(self):
+        return self._size
+
+    def version(self):
+        return self._version
+
+    def commit(self):
+        # Searching changes nothing, so a query path never rewrites the files it reads
+        if self.path and self._version != self._saved_version:
+            self.save(self.path)
+
+    def rollback(self):
+        if self.path and self._version != self._saved_version and (Path(self.path) / "meta.json").exists():
+            self.__dict__.update(NumPyVectorStore.load(self.path, mmap=self._mmap,
+                                                       quantization=self.quantization,
+                                                       rerank_factor=self.rerank_factor).__dict__)
+
+    def save(self, path):
+        """Write the store to a directory: embeddings.npy, chunks.jsonl and meta.json (plus codes.npy
+        and scales.npy when quantized).
+
+        Each file is written to a temporary name and moved into place, so a store
+        memory-mapped from the old files (even this one) keeps reading them intact.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        _write_replacing(path / "embeddings.npy", lambda f: np.save(f, self.matrix))
+        if self.quantization != "none":
+            _write_replacing(path / "codes.npy", lambda f: np.save(f, self.codes))
+            if self._scales is not None:
+                _write_replacing(path / "scales.npy", lambda f: np.save(f, self.scales))
+
+        def write_chunks(f):
+            for row in zip(self.ids, self.filenames, self.chunk_indexes, self.contents,
+                           self.file_types, self.tags, self.mtimes):
+                # NaN is not valid JSON; unknown mtimes are written as null
+                f.write((json.dumps(row[:6] + (None if np.isnan(row[6]) else row[6],)) + "\n").encode("utf-8"))
+        _write_replacing(path / "chunks.jsonl", write_chunks)
+        meta = {"dim": self.dim, "dtype": self.dtype.name, "version": self._version, "next_id": self._next_id,
+                "quantization": self.quantization}
+        # Written last: a store whose meta.json is in place is complete
+        _write_replacing(path / "meta.json", lambda f: f.write(json.dumps(meta).encode("utf-8")))
+        if self.path and Path(self.path) == path:
+            self._saved_version = self._version
+
+    @classmethod
+    def load(cls, path, mmap=False, quantization=None, rerank_factor=DEFAULT_RERANK_FACTOR):
+        """Open a saved store; mmap=True maps the embeddings instead of reading them.
+
+        quantization defaults to the one the store was saved with; codes are
+        rebuilt from the embeddings when a different one is asked for.
+        """
+        path = Path(path)
+        meta = json.loads((path / "meta.json").read_text())
+        saved_quantization = meta.get("quantization", "none")
+        quantization = quantization or saved_quantization
+        store = cls(meta["dim"], meta["dtype"], path, quantization, rerank_factor)
+        store._matrix = np.load(path / "embeddings.npy", mmap_mode="r" if mmap else None)
+        store._mmap = mmap
+        store._size = len(store._matrix)
+        if quantization != "none":
+            if quantization == saved_quantization:
+                store._codes = np.load(path / "codes.npy")
+                store._scales = np.load(path / "scales.npy") if (path / "scales.npy").exists() else None
+            else:
+                store._encode()
+        with open(path / "chunks.jsonl", encoding="utf-8") as f:
+            for line in f:
+                chunk_id, filename, chunk_index, content, *info = json.loads(line)
+                # Stores saved before metadata was kept only have what the filename tells
+                file_type, tags, mtime = info or file_metadata(filename)
+                store.ids.append(chunk_id)
+                store.filenames.append(filename)
+                store.chunk_indexes.append(chunk_index)
+                store.contents.append(content)
+                store.file_types.append(file_type)
+                store.tags.append(tags)
+                store.mtimes.append(np.nan if mtime is None else mtime)
+        store._next_id = meta["next_id"]
+        store._version = store._saved_version = meta["version"]
+        return store